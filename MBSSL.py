@@ -8,14 +8,24 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.parameter import Parameter
+from torch.utils.checkpoint import checkpoint
+import functools
 import sys
-import copy
 from utility.helper import *
 from utility.batch_test import *
 import multiprocessing
 import torch.multiprocessing
 import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from utility.optimize import HMG
+from utility.similarity import top_k_mask
+from utility.batches import TrainBatches
+from utility.prefetch import Prefetcher, to_device
+from utility.sampling import NeighborSampler, sparse_to_csr, local_ids, local_mask_indices
+from utility.contrast import chunked_logsumexp, weighted_sum, NormalizedEmbeddings
+from utility.distributed import launch, is_launcher, init_distributed, close_distributed, all_reduce_, \
+    backward_reduced, broadcast_parameters, broadcast_flag, shard, SharedArrays, csr_tensor
 
 
 class Augmentor():
@@ -23,27 +33,32 @@ class Augmentor():
         self.n_users = data_config['n_users']
         self.n_items = data_config['n_items']
         self.train_matrix = data_config['trn_mat']
+        self.train_edges = data_config['trn_edges']
         self.training_user, self.training_item = self.get_train_interactions()
         self.ssl_ratio = args.ssl_ratio
         self.aug_type = args.aug_type
+        self.aug_engine = args.aug_engine
+        self.device = data_config['device']
+        if self.aug_engine == 'torch':
+            # target-behavior edge list of the torch engine
+            self.edge_user = torch.tensor(self.training_user, dtype=torch.long, device=self.device)
+            self.edge_item = torch.tensor(self.training_item, dtype=torch.long, device=self.device)
 
     def get_train_interactions(self):
-        users_list, items_list = [], []
-        for (user, item), value in self.train_matrix.items():
-            users_list.append(user)
-            items_list.append(item)
+        # in input order, so an edge dropout with a given seed drops the same edges as the former DOK loader
+        users_list, items_list = self.train_edges
 
-        return users_list, items_list
+        return users_list.tolist(), items_list.tolist()
 
-    def augment_adj_mat(self, aug_type=0):
+    def augment_adj_mat(self, aug_type=0, rng=np.random):
         np.seterr(divide='ignore')
         n_nodes = self.n_users + self.n_items
         if aug_type in [0, 1, 2] and self.ssl_ratio > 0:
             # data augmentation type --- 0: Node Dropout; 1: Edge Dropout; 2: Random Walk
             if aug_type == 0:
-                drop_user_idx = np.random.choice(self.n_users, size=int(self.n_users * self.ssl_ratio),
+                drop_user_idx = rng.choice(self.n_users, size=int(self.n_users * self.ssl_ratio),
                                                  replace=False)
-                drop_item_idx = np.random.choice(self.n_items, size=int(self.n_items * self.ssl_ratio),
+                drop_item_idx = rng.choice(self.n_items, size=int(self.n_items * self.ssl_ratio),
                                                  replace=False)
                 indicator_user = np.ones(self.n_users, dtype=np.float32)
                 indicator_item = np.ones(self.n_items, dtype=np.float32)
@@ -61,7 +76,7 @@ class Augmentor():
                 tmp_adj = sp.csr_matrix((ratings_keep, (user_np_keep, item_np_keep + self.n_users)),
                                         shape=(n_nodes, n_nodes))
             if aug_type in [1, 2]:
-                keep_idx = np.random.choice(len(self.training_user),
+                keep_idx = rng.choice(len(self.training_user),
                                             size=int(len(self.training_user) * (1 - self.ssl_ratio)),
                                             replace=False)
                 user_np = np.array(self.training_user)[keep_idx]
@@ -80,6 +95,73 @@ class Augmentor():
         # print(adj_matrix.tocsr())
         return adj_matrix.tocsr()
 
+    def augment_sp_tensor(self, aug_type=0, generator=None):
+        """Torch counterpart of augment_adj_mat: drops nodes / edges of the target edge list with a boolean mask
+        and emits the D^-1/2 A D^-1/2 sparse tensor directly, without a scipy round trip."""
+        n_nodes = self.n_users + self.n_items
+        users, items = self.edge_user, self.edge_item
+        if aug_type in [0, 1, 2] and self.ssl_ratio > 0:
+            # data augmentation type --- 0: Node Dropout; 1: Edge Dropout; 2: Random Walk
+            if aug_type == 0:
+                keep_user = torch.ones(self.n_users, dtype=torch.bool, device=self.device)
+                keep_item = torch.ones(self.n_items, dtype=torch.bool, device=self.device)
+                keep_user[torch.randperm(self.n_users, generator=generator, device=self.device)[
+                          :int(self.n_users * self.ssl_ratio)]] = False
+                keep_item[torch.randperm(self.n_items, generator=generator, device=self.device)[
+                          :int(self.n_items * self.ssl_ratio)]] = False
+                keep = keep_user[users] & keep_item[items]
+            else:
+                keep = torch.zeros(len(users), dtype=torch.bool, device=self.device)
+                keep[torch.randperm(len(users), generator=generator, device=self.device)[
+                     :int(len(users) * (1 - self.ssl_ratio))]] = True
+            users, items = users[keep], items[keep]
+
+        items = items + self.n_users
+        rows = torch.cat([users, items])
+        cols = torch.cat([items, users])
+        d_inv = torch.bincount(rows, minlength=n_nodes).float().pow(-0.5)
+        d_inv[torch.isinf(d_inv)] = 0.
+        return torch.sparse_coo_tensor(torch.stack([rows, cols]), d_inv[rows] * d_inv[cols],
+                                       (n_nodes, n_nodes)).coalesce()
+
+    def sub_mats(self, n_layers, convert, rng=np.random):
+        """Augmented graphs of one epoch: sub1 / sub2 shared by all layers, or sub1k / sub2k for every layer k
+        with aug_type 2."""
+        if self.aug_type in [0, 1]:
+            names = ['sub1', 'sub2']
+        else:
+            names = ['sub%d%d' % (view, k) for k in range(1, n_layers + 1) for view in [1, 2]]
+        if self.aug_engine == 'torch':
+            # rng is the torch.Generator of the epoch, None draws from the global torch RNG
+            return {name: self.augment_sp_tensor(aug_type=self.aug_type, generator=rng) for name in names}
+        return {name: convert(self.augment_adj_mat(aug_type=self.aug_type, rng=rng)) for name in names}
+
+    def generate(self, n_epochs, n_layers, convert, ahead=1, n_workers=1):
+        """Yield the sub_mats of every epoch, generated by background workers up to ``ahead`` epochs in advance.
+
+        Epoch e draws from its own RNG stream seeded with (seed, e), the seed being drawn once from np.random, so
+        the graphs depend on neither the number of workers nor their timing. With ``ahead`` 0 the graphs are
+        generated on demand from the global RNG (torch's or numpy's, depending on the engine).
+        """
+        if ahead <= 0:
+            for _ in range(n_epochs):
+                yield self.sub_mats(n_layers, convert, None if self.aug_engine == 'torch' else np.random)
+            return
+
+        seed = np.random.randint(1 << 31)
+        executor = ThreadPoolExecutor(n_workers)
+        futures = deque()
+        try:
+            for epoch in range(n_epochs):
+                while len(futures) <= ahead and epoch + len(futures) < n_epochs:
+                    rng = np.random.default_rng([seed, epoch + len(futures)])
+                    if self.aug_engine == 'torch':
+                        rng = torch.Generator(self.device).manual_seed(int(rng.integers(1 << 62)))
+                    futures.append(executor.submit(self.sub_mats, n_layers, convert, rng))
+                yield futures.popleft().result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
 
 class MBSSL(nn.Module):
     name = 'MBSSL'
@@ -92,7 +174,11 @@ class MBSSL(nn.Module):
         self.n_items = data_config['n_items']
         self.num_nodes = self.n_users + self.n_items
         self.pre_adjs = data_config['pre_adjs']
-        self.pre_adjs_tensor = [self._convert_sp_mat_to_sp_tensor(adj).to(device) for adj in self.pre_adjs]
+        if data_config.get('shared_adjs'):
+            # CSR tensors over the arrays shared by the workers of the host
+            self.pre_adjs_tensor = [csr_tensor(adj).to(device) for adj in self.pre_adjs]
+        else:
+            self.pre_adjs_tensor = [self._convert_sp_mat_to_sp_tensor(adj).to(device) for adj in self.pre_adjs]
         self.behs = data_config['behs']
         self.n_relations = len(self.behs)
         # ********************** hyper parameters *********************** #
@@ -105,6 +191,8 @@ class MBSSL(nn.Module):
         self.aug_type = args.aug_type
         self.nhead = args.nhead
         self.att_dim = args.att_dim
+        # per view (main, sub1, sub2): recompute the layers in backward instead of keeping their activations
+        self.checkpoint = eval(args.checkpoint)
         # ********************** learnable parameters *********************** #
         self.all_weights = {}
         self.all_weights['user_embedding'] = Parameter(torch.FloatTensor(self.n_users, self.emb_dim))
@@ -144,24 +232,112 @@ class MBSSL(nn.Module):
         shape = coo.shape
         return torch.sparse.FloatTensor(torch.LongTensor(indices), torch.FloatTensor(values), torch.Size(shape))
 
-    def forward(self, sub_mats, device):
+    def view_adjs(self, sub_mats, device):
+        """Per-relation propagation graphs of every layer, for the main view and the two augmented views: the
+        augmented views replace the target relation by their sub graphs."""
         self.sub_mat = {}
+        # moved once, so the layers sharing a sub graph share its tensor
+        sub_mats = {name: sub_mat.to(device) for name, sub_mat in sub_mats.items()}
         for k in range(1, self.n_layers + 1):
             if self.aug_type in [0, 1]:
-                self.sub_mat['sub_mat_1%d' % k] = sub_mats['sub1'].to(device)
-                self.sub_mat['sub_mat_2%d' % k] = sub_mats['sub2'].to(device)
+                self.sub_mat['sub_mat_1%d' % k] = sub_mats['sub1']
+                self.sub_mat['sub_mat_2%d' % k] = sub_mats['sub2']
             else:
-                self.sub_mat['sub_mat_1%d' % k] = sub_mats['sub1%d' % k].to(device)
-                self.sub_mat['sub_mat_2%d' % k] = sub_mats['sub2%d' % k].to(device)
-
-        ego_embeddings = torch.cat((self.all_weights['user_embedding'], self.all_weights['item_embedding']),
-                                   dim=0).unsqueeze(1).repeat(1, self.n_relations, 1)
-        ego_embeddings_sub1 = ego_embeddings
-        ego_embeddings_sub2 = ego_embeddings
+                self.sub_mat['sub_mat_1%d' % k] = sub_mats['sub1%d' % k]
+                self.sub_mat['sub_mat_2%d' % k] = sub_mats['sub2%d' % k]
+
+        main_adjs = [self.pre_adjs_tensor for k in range(self.n_layers)]
+        sub1_adjs = [self.pre_adjs_tensor[:-1] + [self.sub_mat['sub_mat_1%d' % (k + 1)]] for k in range(self.n_layers)]
+        sub2_adjs = [self.pre_adjs_tensor[:-1] + [self.sub_mat['sub_mat_2%d' % (k + 1)]] for k in range(self.n_layers)]
+        return [main_adjs, sub1_adjs, sub2_adjs]
+
+    def node_embeddings(self, nodes):
+        # nodes are sorted, so the users come first
+        n_user_nodes = int(torch.searchsorted(nodes, self.n_users))
+        return torch.cat((self.all_weights['user_embedding'][nodes[:n_user_nodes]],
+                          self.all_weights['item_embedding'][nodes[n_user_nodes:] - self.n_users]), dim=0)
+
+    def aggregate(self, view_egos, view_adjs):
+        """Message passing of one layer: ``view_adjs[v][i] @ view_egos[v][:, i, :]`` for every view v and
+        relation i. Views sharing the adjacency of a relation (the non-target relations of the full graph) are
+        multiplied at once, with their embeddings concatenated along the features, so the sparse matrix is
+        traversed once instead of once per view."""
+        aggregated = [[None] * self.n_relations for _ in view_egos]
+        # sparse products stay in fp32 under bf16 autocast
+        with torch.autocast(view_egos[0].device.type, enabled=False):
+            for i in range(self.n_relations):
+                groups = {}
+                for v, adjs in enumerate(view_adjs):
+                    groups.setdefault(id(adjs[i]), []).append(v)
+                for views in groups.values():
+                    adj = view_adjs[views[0]][i]
+                    if len(views) == 1:
+                        embeddings_ = [torch.matmul(adj, view_egos[views[0]][:, i, :].float())]
+                    else:
+                        embeddings_ = torch.cat([view_egos[v][:, i, :] for v in views], dim=1)
+                        embeddings_ = torch.matmul(adj, embeddings_.float())
+                        embeddings_ = torch.split(embeddings_, view_egos[views[0]].shape[2], dim=1)
+                    for v, embedding_ in zip(views, embeddings_):
+                        aggregated[v][i] = embedding_
+        return aggregated
+
+    def propagate(self, view_aggregated, k, rela_embs):
+        """Layer k after message passing (``view_aggregated[v][i]``, [n_out, dim] per view and relation): the
+        transform by the [n_relations, dim] relation embeddings ``rela_embs`` and the cross-relation attention,
+        for every relation at once, and for every view at once when their node sets have the same size. Returns
+        the [n_out, n_relations, dim] embeddings and the [n_out, n_relations, n_relations] attention of every
+        view."""
+        if len(set(aggregated[0].shape[0] for aggregated in view_aggregated)) > 1:
+            outputs = [self.propagate([aggregated], k, rela_embs) for aggregated in view_aggregated]
+            return [embs[0] for embs, _ in outputs], [attn[0] for _, attn in outputs]
+
+        embeddings_st = torch.stack([torch.stack(aggregated, dim=1) for aggregated in view_aggregated])
+        embeddings_st = self.leaky_relu(
+            torch.matmul(torch.mul(embeddings_st, rela_embs), self.all_weights['W_gc_%d' % k]))  # [V, N, R, dim]
+
+        # attention of relation i over the relations r of a node: softmax_r(tanh(e_r @ s1_i) @ s2_i)
+        attention = torch.tanh(torch.einsum('vnrd,ida->vnira', embeddings_st, self.all_weights['trans_weights_s1']))
+        attention = torch.einsum('vnira,ia->vnir', attention, self.all_weights['trans_weights_s2'].squeeze(2))
+        attention = F.softmax(attention, dim=3)  # [V, N, R, R]
+        embeddings = torch.matmul(attention, embeddings_st)  # [V, N, R, dim]
+        # per-view selects (not unbind), so the views can be modified in place afterwards
+        return [embeddings[v] for v in range(len(view_aggregated))], [attention[v] for v in range(len(view_aggregated))]
+
+    def layer(self, k, view_adjs, rela_embs, *view_egos):
+        """Layer k of some views: message passing, attention and dropout. Returns the embeddings of every view,
+        then their attention."""
+        aggregated = self.aggregate(view_egos, view_adjs)
+        view_embeddings, view_attention = self.propagate(aggregated, k, rela_embs)
+        return tuple(self.dropout(embeddings) for embeddings in view_embeddings) + tuple(view_attention)
+
+    def view_groups(self):
+        groups = [[0]]
+        for v in range(1, 3):
+            if self.checkpoint[v] == self.checkpoint[groups[-1][0]]:
+                groups[-1].append(v)
+            else:
+                groups.append([v])
+        return groups
+
+    def forward(self, sub_mats, device, graph=None):
+        """Full-graph propagation, or with a SampledGraph only the propagation of its receptive field: the
+        outputs then hold the seed users and seed items (plus the padding token) in the order of graph.seeds."""
+        if graph is None:
+            view_adjs = self.view_adjs(sub_mats, device)
+            ego_embeddings = torch.cat((self.all_weights['user_embedding'], self.all_weights['item_embedding']),
+                                       dim=0).unsqueeze(1).expand(-1, self.n_relations, -1)
+            view_egos = [ego_embeddings] * 3
+            view_out_pos = [[None] * (self.n_layers + 1)] * 3
+            n_out_users, n_out_items = self.n_users, self.n_items
+        else:
+            view_adjs = graph.adjs
+            view_egos = [self.node_embeddings(nodes[0]).unsqueeze(1).expand(-1, self.n_relations, -1)
+                         for nodes in graph.nodes]
+            view_out_pos = graph.out_pos
+            n_out_users = int(torch.searchsorted(graph.seeds, self.n_users))
+            n_out_items = len(graph.seeds) - n_out_users
 
-        all_embeddings = ego_embeddings
-        all_embeddings_sub1 = ego_embeddings_sub1
-        all_embeddings_sub2 = ego_embeddings_sub2
+        view_alls = [ego if out_pos[0] is None else ego[out_pos[0]] for ego, out_pos in zip(view_egos, view_out_pos)]
 
         all_rela_embs = {}
         for i in range(self.n_relations):
@@ -170,122 +346,47 @@ class MBSSL(nn.Module):
             rela_emb = torch.reshape(rela_emb, (-1, self.emb_dim))
             all_rela_embs[beh] = [rela_emb]
 
-        total_mm_time = 0.
         for k in range(0, self.n_layers):
-            embeddings_list = []
-            for i in range(self.n_relations):
-                st = time()
-                embeddings_ = torch.matmul(self.pre_adjs_tensor[i], ego_embeddings[:, i, :])
-                total_mm_time += time() - st
-                rela_emb = all_rela_embs[self.behs[i]][k]
-                embeddings_ = self.leaky_relu(
-                    torch.matmul(torch.mul(embeddings_, rela_emb), self.all_weights['W_gc_%d' % k]))
-                embeddings_list.append(embeddings_)
-            embeddings_st = torch.stack(embeddings_list, dim=1)
-            embeddings_list = []
-            attention_list = []
-            for i in range(self.n_relations):
-                attention = F.softmax(
-                    torch.matmul(
-                        torch.tanh(torch.matmul(embeddings_st, self.all_weights['trans_weights_s1'][i])),
-                        self.all_weights['trans_weights_s2'][i]
-                    ).squeeze(2),
-                    dim=1
-                ).unsqueeze(1)
-                attention_list.append(attention)
-                embs_cur_rela = torch.matmul(attention, embeddings_st).squeeze(1)
-                embeddings_list.append(embs_cur_rela)
-            ego_embeddings = torch.stack(embeddings_list, dim=1)
-            attn = torch.cat(attention_list, dim=1)
-            ego_embeddings = self.dropout(ego_embeddings)
-            all_embeddings = all_embeddings + ego_embeddings
-
-            embeddings_list_sub1 = []
-            for i in range(self.n_relations):
-                rela_emb = all_rela_embs[self.behs[i]][k]
-                st = time()
-                if i != self.n_relations - 1:
-                    embeddings_ = torch.matmul(self.pre_adjs_tensor[i], ego_embeddings_sub1[:, i, :])
-                else:
-                    embeddings_ = torch.matmul(self.sub_mat['sub_mat_1%d' % (k + 1)],
-                                               ego_embeddings_sub1[:, i, :])
-                total_mm_time += time() - st
-                embeddings_ = self.leaky_relu(
-                    torch.matmul(torch.mul(embeddings_, rela_emb), self.all_weights['W_gc_%d' % k]))
-                embeddings_list_sub1.append(embeddings_)
-
-            embeddings_st = torch.stack(embeddings_list_sub1, dim=1)
-
-            embeddings_list_sub1 = []
-            for i in range(self.n_relations):
-                attention = F.softmax(
-                    torch.matmul(
-                        torch.tanh(torch.matmul(embeddings_st, self.all_weights['trans_weights_s1'][i])),
-                        self.all_weights['trans_weights_s2'][i]
-                    ).squeeze(2),
-                    dim=1
-                ).unsqueeze(1)
-                embs_cur_rela = torch.matmul(attention, embeddings_st).squeeze(1)
-                embeddings_list_sub1.append(embs_cur_rela)
-            ego_embeddings_sub1 = torch.stack(embeddings_list_sub1, dim=1)
-            ego_embeddings_sub1 = self.dropout(ego_embeddings_sub1)
-            all_embeddings_sub1 = all_embeddings_sub1 + ego_embeddings_sub1
-
-            embeddings_list_sub2 = []
-            for i in range(self.n_relations):
-                rela_emb = all_rela_embs[self.behs[i]][k]
-                st = time()
-                if i != self.n_relations - 1:
-                    embeddings_ = torch.matmul(self.pre_adjs_tensor[i], ego_embeddings_sub2[:, i, :])
+            # runs of consecutive views with the same checkpoint flag, so dropout still draws view by view
+            rela_embs = torch.cat([all_rela_embs[beh][k] for beh in self.behs], dim=0)  # [R, dim]
+            view_outputs = []
+            for views in self.view_groups():
+                layer = functools.partial(self.layer, k, [view_adjs[v][k] for v in views], rela_embs)
+                view_inputs = [view_egos[v] for v in views]
+                if self.checkpoint[views[0]] and torch.is_grad_enabled():
+                    outputs = checkpoint(layer, *view_inputs, use_reentrant=False)
                 else:
-                    embeddings_ = torch.matmul(self.sub_mat['sub_mat_2%d' % (k + 1)],
-                                               ego_embeddings_sub2[:, i, :])
-                total_mm_time += time() - st
-                embeddings_ = self.leaky_relu(
-                    torch.matmul(torch.mul(embeddings_, rela_emb), self.all_weights['W_gc_%d' % k]))
-                embeddings_list_sub2.append(embeddings_)
-
-            embeddings_st = torch.stack(embeddings_list_sub2, dim=1)
-            embeddings_list_sub2 = []
-            for i in range(self.n_relations):
-                attention = F.softmax(
-                    torch.matmul(
-                        torch.tanh(torch.matmul(embeddings_st, self.all_weights['trans_weights_s1'][i])),
-                        self.all_weights['trans_weights_s2'][i]
-                    ).squeeze(2),
-                    dim=1
-                ).unsqueeze(1)
-                embs_cur_rela = torch.matmul(attention, embeddings_st).squeeze(1)
-                embeddings_list_sub2.append(embs_cur_rela)
-            ego_embeddings_sub2 = torch.stack(embeddings_list_sub2, dim=1)
-
-            ego_embeddings_sub2 = self.dropout(ego_embeddings_sub2)
-            all_embeddings_sub2 = all_embeddings_sub2 + ego_embeddings_sub2
+                    outputs = layer(*view_inputs)
+                view_outputs += list(zip(outputs[:len(views)], outputs[len(views):]))
+            attn = view_outputs[0][1]
+            # main view, then the two augmented views
+            for v in range(3):
+                ego_embeddings = view_outputs[v][0]
+                view_egos[v] = ego_embeddings
+                out_pos = view_out_pos[v][k + 1]
+                view_alls[v] = view_alls[v] + (ego_embeddings if out_pos is None else ego_embeddings[out_pos])
 
             for i in range(self.n_relations):
                 rela_emb = torch.matmul(all_rela_embs[self.behs[i]][k],
                                         self.all_weights['W_rel_%d' % k])
                 all_rela_embs[self.behs[i]].append(rela_emb)
 
-        all_embeddings /= self.n_layers + 1
-        u_g_embeddings, i_g_embeddings = torch.split(all_embeddings, [self.n_users, self.n_items], 0)
         token_embedding = torch.zeros([1, self.n_relations, self.emb_dim], device=device)
-        i_g_embeddings = torch.cat((i_g_embeddings, token_embedding), dim=0)
+        outputs = []
+        for all_embeddings in view_alls:
+            all_embeddings = all_embeddings / (self.n_layers + 1)
+            u_g_embeddings, i_g_embeddings = torch.split(all_embeddings, [n_out_users, n_out_items], 0)
+            i_g_embeddings = torch.cat((i_g_embeddings, token_embedding), dim=0)
+            outputs += [u_g_embeddings, i_g_embeddings]
 
-        all_embeddings_sub1 /= self.n_layers + 1
-        u_g_embeddings_sub1, i_g_embeddings_sub1 = torch.split(all_embeddings_sub1, [self.n_users, self.n_items], 0)
-        i_g_embeddings_sub1 = torch.cat((i_g_embeddings_sub1, token_embedding), dim=0)
-
-        all_embeddings_sub2 /= self.n_layers + 1
-        u_g_embeddings_sub2, i_g_embeddings_sub2 = torch.split(all_embeddings_sub2, [self.n_users, self.n_items], 0)
-        i_g_embeddings_sub2 = torch.cat((i_g_embeddings_sub2, token_embedding), dim=0)
-
-        attn_user, attn_item = torch.split(attn, [self.n_users, self.n_items], 0)
+        if view_out_pos[0][-1] is not None:
+            attn = attn[view_out_pos[0][-1]]
+        attn_user, attn_item = torch.split(attn, [n_out_users, n_out_items], 0)
 
         for i in range(self.n_relations):
             all_rela_embs[self.behs[i]] = torch.mean(torch.stack(all_rela_embs[self.behs[i]], 0), 0)
 
-        return u_g_embeddings, i_g_embeddings, u_g_embeddings_sub1, i_g_embeddings_sub1, u_g_embeddings_sub2, i_g_embeddings_sub2, all_rela_embs, attn_user, attn_item
+        return outputs + [all_rela_embs, attn_user, attn_item]
 
 
 class RecLoss(nn.Module):
@@ -299,7 +400,8 @@ class RecLoss(nn.Module):
         self.coefficient = eval(args.coefficient)
         self.wid = eval(args.wid)
 
-    def forward(self, input_u, label_phs, ua_embeddings, ia_embeddings, rela_embeddings):
+    def forward(self, input_u, label_phs, ua_embeddings, ia_embeddings, rela_embeddings, n_shards=1):
+        # n_shards: number of workers sharing the batch, which all regularize the same full item embeddings
         uid = ua_embeddings[input_u]
         uid = torch.reshape(uid, (-1, self.n_relations, self.emb_dim))
         pos_r_list = []
@@ -311,7 +413,7 @@ class RecLoss(nn.Module):
                                    pos_beh)  # [B, max_item] * [B, max_item, dim] -> [B, max_item, dim]
             pos_r = torch.einsum('ac,abc->abc', uid[:, i, :],
                                  pos_beh)  # [B, dim] * [B, max_item, dim] -> [B, max_item, dim]
-            pos_r = torch.einsum('ajk,lk->aj', pos_r, rela_embeddings[beh])
+            pos_r = torch.einsum('ajk,lk->aj', pos_r, rela_embeddings[beh]).float()
             pos_r_list.append(pos_r)
 
         loss = 0.
@@ -320,12 +422,39 @@ class RecLoss(nn.Module):
             temp = torch.einsum('ab,ac->bc', ia_embeddings[:, i, :], ia_embeddings[:, i, :]) \
                    * torch.einsum('ab,ac->bc', uid[:, i, :], uid[:, i, :])  # [B, dim]' * [B, dim] -> [dim, dim]
             tmp_loss = self.wid[i] * torch.sum(
-                temp * torch.matmul(rela_embeddings[beh].T, rela_embeddings[beh]))
+                temp.float() * torch.matmul(rela_embeddings[beh].T, rela_embeddings[beh]).float())
             tmp_loss += torch.sum((1.0 - self.wid[i]) * torch.square(pos_r_list[i]) - 2.0 * pos_r_list[i])
 
             loss += self.coefficient[i] * tmp_loss
 
-        regularizer = torch.sum(torch.square(uid)) * 0.5 + torch.sum(torch.square(ia_embeddings)) * 0.5
+        regularizer = torch.sum(torch.square(uid)) * 0.5 + torch.sum(torch.square(ia_embeddings)) * 0.5 / n_shards
+        emb_loss = args.decay * regularizer
+
+        return loss, emb_loss
+
+
+class SegmentRecLoss(RecLoss):
+    """RecLoss over the CSR positives of the batch users, [(rows, items), ...] per behavior with rows indexing
+    the batch, instead of padded labels: no einsum over padding, and no positive is truncated. The whole-data
+    term takes the [n_relations, dim, dim] item Gram matrices of one batched product per forward."""
+
+    def forward(self, input_u, positives, ua_embeddings, ia_embeddings, rela_embeddings, n_shards=1):
+        uid = ua_embeddings[input_u[:, 0]]  # [B, n_relations, dim]
+        rela = torch.cat([rela_embeddings[beh] for beh in self.behs])  # [n_relations, dim]
+        item_gram = torch.einsum('nrb,nrc->rbc', ia_embeddings, ia_embeddings)
+        user_gram = torch.einsum('nrb,nrc->rbc', uid, uid)
+        rela_gram = torch.einsum('rb,rc->rbc', rela, rela)
+
+        loss = 0.
+        for i in range(self.n_relations):
+            rows, items = positives[i]
+            pos_r = torch.sum(uid[rows, i, :] * ia_embeddings[items, i, :] * rela[i], dim=1).float()  # [nnz]
+            tmp_loss = self.wid[i] * torch.sum((item_gram[i] * user_gram[i]).float() * rela_gram[i].float())
+            tmp_loss += torch.sum((1.0 - self.wid[i]) * torch.square(pos_r) - 2.0 * pos_r)
+
+            loss += self.coefficient[i] * tmp_loss
+
+        regularizer = torch.sum(torch.square(uid)) * 0.5 + torch.sum(torch.square(ia_embeddings)) * 0.5 / n_shards
         emb_loss = args.decay * regularizer
 
         return loss, emb_loss
@@ -337,39 +466,22 @@ class SSLoss(nn.Module):
         self.ssl_temp = args.ssl_temp
         self.ssl_reg = args.ssl_reg
         self.ssl_mode = args.ssl_mode
+        # negatives of the InfoNCE denominator: full, chunked (full, streamed over blocks), in_batch or sampled
+        self.ssl_neg = args.ssl_neg
+        self.ssl_chunk = args.ssl_chunk
+        self.ssl_n_neg = args.ssl_n_neg
 
     def forward(self, input_u_list, input_i_list, ua_embeddings_sub1, ua_embeddings_sub2, ia_embeddings_sub1,
-                ia_embeddings_sub2):
+                ia_embeddings_sub2, norm_cache=None, u_weights=None, i_weights=None):
+        # norm_cache: NormalizedEmbeddings of the forward, with the sub2 tables as 'ua_sub2' and 'ia_sub2'
+        # u_weights, i_weights: multiplicity of every node of input_u_list / input_i_list (once if None)
         if self.ssl_mode in ['user_side', 'both_side']:
-            user_emb1 = ua_embeddings_sub1[input_u_list]
-            user_emb2 = ua_embeddings_sub2[input_u_list]  # [B, dim]
-            normalize_user_emb1 = F.normalize(user_emb1, dim=1)
-            normalize_user_emb2 = F.normalize(user_emb2, dim=1)
-            normalize_all_user_emb2 = F.normalize(ua_embeddings_sub2, dim=1)
-            pos_score_user = torch.sum(torch.mul(normalize_user_emb1, normalize_user_emb2),
-                                       dim=1)
-            pos_score_user = torch.exp(pos_score_user / self.ssl_temp)
-
-            ttl_score_user = torch.matmul(normalize_user_emb1,
-                                          normalize_all_user_emb2.T)
-            ttl_score_user = torch.sum(torch.exp(ttl_score_user / self.ssl_temp), dim=1)  # [B, ]
-
-            ssl_loss_user = -torch.sum(torch.log(pos_score_user / ttl_score_user))
+            ssl_loss_user = self.side_loss(input_u_list, ua_embeddings_sub1, ua_embeddings_sub2, norm_cache, 'ua_sub2',
+                                           u_weights)
 
         if self.ssl_mode in ['item_side', 'both_side']:
-            item_emb1 = ia_embeddings_sub1[input_i_list]
-            item_emb2 = ia_embeddings_sub2[input_i_list]
-
-            normalize_item_emb1 = F.normalize(item_emb1, dim=1)
-            normalize_item_emb2 = F.normalize(item_emb2, dim=1)
-            normalize_all_item_emb2 = F.normalize(ia_embeddings_sub2, dim=1)
-            pos_score_item = torch.sum(torch.mul(normalize_item_emb1, normalize_item_emb2), dim=1)
-            ttl_score_item = torch.matmul(normalize_item_emb1, normalize_all_item_emb2.T)
-
-            pos_score_item = torch.exp(pos_score_item / self.ssl_temp)
-            ttl_score_item = torch.sum(torch.exp(ttl_score_item / self.ssl_temp), dim=1)
-
-            ssl_loss_item = -torch.sum(torch.log(pos_score_item / ttl_score_item))
+            ssl_loss_item = self.side_loss(input_i_list, ia_embeddings_sub1, ia_embeddings_sub2, norm_cache, 'ia_sub2',
+                                           i_weights)
 
         if self.ssl_mode == 'user_side':
             ssl_loss = self.ssl_reg * ssl_loss_user
@@ -380,6 +492,38 @@ class SSLoss(nn.Module):
 
         return ssl_loss
 
+    def side_loss(self, input_list, embeddings_sub1, embeddings_sub2, norm_cache=None, key=None, weights=None):
+        """InfoNCE of the [B,] node ids, each counted ``weights`` times, between the [N, dim] embeddings of the
+        two views; the normalized sub2 table is ``norm_cache[key]`` when given."""
+        emb1 = embeddings_sub1[input_list]
+        emb2 = embeddings_sub2[input_list]  # [B, dim]
+        normalize_emb1 = F.normalize(emb1, dim=1)
+        normalize_emb2 = F.normalize(emb2, dim=1)
+        pos_score = torch.sum(torch.mul(normalize_emb1, normalize_emb2), dim=1)
+
+        if self.ssl_neg == 'full':
+            normalize_all_emb2 = F.normalize(embeddings_sub2, dim=1) if norm_cache is None else norm_cache[key]
+            pos_score = torch.exp(pos_score / self.ssl_temp)
+            ttl_score = torch.matmul(normalize_emb1, normalize_all_emb2.T).float()
+            ttl_score = torch.sum(torch.exp(ttl_score / self.ssl_temp), dim=1)  # [B, ]
+            return -weighted_sum(torch.log(pos_score / ttl_score), weights)
+
+        if self.ssl_neg == 'chunked':
+            # [B, N] scores never materialized: O(B * ssl_chunk) memory
+            log_ttl_score = chunked_logsumexp(normalize_emb1, embeddings_sub2, self.ssl_temp, self.ssl_chunk)
+        else:
+            if self.ssl_neg == 'in_batch':
+                # the distinct nodes of the batch, the positive among them
+                neg = torch.unique(input_list)
+            else:
+                # ssl_n_neg nodes drawn uniformly, shared by the batch, next to the positive
+                neg = torch.randint(len(embeddings_sub2), (self.ssl_n_neg,), device=input_list.device)
+            ttl_score = torch.matmul(normalize_emb1, F.normalize(embeddings_sub2[neg], dim=1).T).float()
+            if self.ssl_neg == 'sampled':
+                ttl_score = torch.cat([pos_score.float().unsqueeze(1), ttl_score], dim=1)
+            log_ttl_score = torch.logsumexp(ttl_score / self.ssl_temp, dim=1)
+        return -weighted_sum(pos_score.float() / self.ssl_temp - log_ttl_score, weights)
+
 
 class SSLoss2(nn.Module):
     def __init__(self, data_config, args):
@@ -393,91 +537,89 @@ class SSLoss2(nn.Module):
         self.user_indices_remove, self.item_indices_remove = None, None
 
     def forward(self, input_u_list, input_i_list, ua_embeddings, ia_embeddings, aux_beh, user_batch_indices=None,
-                item_batch_indices=None):
+                item_batch_indices=None, norm_cache=None, u_weights=None, i_weights=None):
+        # norm_cache: NormalizedEmbeddings of the forward, with ua_embeddings and ia_embeddings as 'ua' and 'ia'
+        # u_weights, i_weights: multiplicity of every node of input_u_list / input_i_list (once if None)
         ssl2_loss = 0.
 
         if self.ssl_mode_inter in ['user_side', 'both_side']:
-            emb_tgt = ua_embeddings[input_u_list, -1, :]  # [B, d]
-            normalize_emb_tgt = F.normalize(emb_tgt, dim=1)
-            emb_aux = ua_embeddings[input_u_list, aux_beh, :]  # [B, d]
-            normalize_emb_aux = F.normalize(emb_aux, dim=1)  # [B, dim]
-            normalize_all_emb_aux = F.normalize(ua_embeddings[:, aux_beh, :], dim=1)  # [N, dim]
-            pos_score = torch.sum(torch.mul(normalize_emb_tgt, normalize_emb_aux),
-                                  dim=1)  # [B, ]
-            ttl_score = torch.matmul(normalize_emb_tgt, normalize_all_emb_aux.T)  # [B, N]
+            ssl2_loss += self.side_loss(input_u_list, ua_embeddings, aux_beh, user_batch_indices,
+                                        None if norm_cache is None else norm_cache['ua'],
+                                        u_weights) * self.ssl_reg_inter[aux_beh]
 
-            ttl_score[user_batch_indices] = 0.
-            pos_score = torch.exp(pos_score / self.ssl_temp)
-            ttl_score = torch.sum(torch.exp(ttl_score / self.ssl_temp), dim=1)
+        if self.ssl_mode_inter in ['item_side', 'both_side']:
+            ssl2_loss += self.side_loss(input_i_list, ia_embeddings, aux_beh, item_batch_indices,
+                                        None if norm_cache is None else norm_cache['ia'],
+                                        i_weights) * self.ssl_reg_inter[aux_beh]
 
-            ssl2_loss += -torch.sum(torch.log(pos_score / ttl_score)) * self.ssl_reg_inter[aux_beh]
+        return ssl2_loss
 
-        if self.ssl_mode_inter in ['item_side', 'both_side']:
-            emb_tgt = ia_embeddings[input_i_list, -1, :]
+    def side_loss(self, input_list, embeddings, aux_beh, batch_indices, normalized=None, weights=None):
+        """Contrast of the target and the aux_beh embeddings ([N, n_relations, dim]) of the [B,] node ids, each
+        counted ``weights`` times; ``normalized`` is the normalized ``embeddings`` when given."""
+        if normalized is None:
+            emb_tgt = embeddings[input_list, -1, :]  # [B, d]
             normalize_emb_tgt = F.normalize(emb_tgt, dim=1)
-            emb_aux = ia_embeddings[input_i_list, aux_beh, :]
+            emb_aux = embeddings[input_list, aux_beh, :]  # [B, d]
             normalize_emb_aux = F.normalize(emb_aux, dim=1)  # [B, dim]
-            normalize_all_emb_aux = F.normalize(ia_embeddings[:, aux_beh, :], dim=1)  # [N, dim]
-            pos_score = torch.sum(torch.mul(normalize_emb_tgt, normalize_emb_aux),
-                                  dim=1)
-            ttl_score = torch.matmul(normalize_emb_tgt, normalize_all_emb_aux.T)
+            normalize_all_emb_aux = F.normalize(embeddings[:, aux_beh, :], dim=1)  # [N, dim]
+        else:
+            normalize_emb_tgt = normalized[input_list, -1, :]
+            normalize_emb_aux = normalized[input_list, aux_beh, :]
+            normalize_all_emb_aux = normalized[:, aux_beh, :]
+        pos_score = torch.sum(torch.mul(normalize_emb_tgt, normalize_emb_aux),
+                              dim=1)  # [B, ]
+        ttl_score = torch.matmul(normalize_emb_tgt, normalize_all_emb_aux.T).float()  # [B, N]
+
+        pos_score = torch.exp(pos_score / self.ssl_temp)
+        ttl_score = torch.sum(torch.exp(ttl_score / self.ssl_temp), dim=1)
+        ttl_score = self.mask_score(ttl_score, normalize_emb_tgt, normalize_all_emb_aux, batch_indices)
+
+        return -weighted_sum(torch.log(pos_score / ttl_score), weights)
+
+    def forward_fused(self, input_u_list, input_i_list, aux_behs, user_batch_indices, item_batch_indices,
+                      norm_cache, u_weights=None, i_weights=None):
+        """Losses of every auxiliary behavior in ``aux_behs`` at once, as a list with one loss per behavior (for
+        HMG): the [B, N] scores of all the behaviors of a side come from one batched matmul."""
+        ssl2_loss = 0.
 
-            ttl_score[item_batch_indices] = 0.
-            pos_score = torch.exp(pos_score / self.ssl_temp)
-            ttl_score = torch.sum(torch.exp(ttl_score / self.ssl_temp), dim=1)
-            ssl2_loss += -torch.sum(torch.log(pos_score / ttl_score)) * self.ssl_reg_inter[aux_beh]
+        if self.ssl_mode_inter in ['user_side', 'both_side']:
+            ssl2_loss += self.fused_side_loss(input_u_list, norm_cache['ua'], aux_behs, user_batch_indices, u_weights)
 
-        return ssl2_loss
+        if self.ssl_mode_inter in ['item_side', 'both_side']:
+            ssl2_loss += self.fused_side_loss(input_i_list, norm_cache['ia'], aux_behs, item_batch_indices, i_weights)
 
+        return [ssl2_loss[a] * self.ssl_reg_inter[aux_beh] for a, aux_beh in enumerate(aux_behs)]
 
-def get_lables(temp_set, k=0.9999):
-    max_item = 0
-    item_lenth = []
-    for i in temp_set:
-        item_lenth.append(len(temp_set[i]))
-        if len(temp_set[i]) > max_item:
-            max_item = len(temp_set[i])
-    item_lenth.sort()
-
-    max_item = item_lenth[int(len(item_lenth) * k) - 1]
-
-    print(max_item)
-    for i in temp_set:
-        if len(temp_set[i]) > max_item:
-            temp_set[i] = temp_set[i][0:max_item]
-        while len(temp_set[i]) < max_item:
-            temp_set[i].append(n_items)
-    return max_item, temp_set
-
-
-def get_train_instances1(max_item_list, beh_label_list):
-    user_train = []
-    beh_item_list = [list() for i in range(n_behs)]  #
-
-    for i in beh_label_list[-1].keys():
-        user_train.append(i)
-        beh_item_list[-1].append(beh_label_list[-1][i])
-        for j in range(n_behs - 1):
-            if not i in beh_label_list[j].keys():
-                beh_item_list[j].append([n_items] * max_item_list[j])
-            else:
-                beh_item_list[j].append(beh_label_list[j][i])
+    def fused_side_loss(self, input_list, normalized, aux_behs, batch_indices, weights=None):
+        """side_loss of every behavior in ``aux_behs``, [A,], from the normalized [N, n_relations, dim]
+        embeddings."""
+        normalize_emb_tgt = normalized[input_list, -1, :]  # [B, dim]
+        normalize_all_emb_aux = normalized[:, aux_behs, :].transpose(0, 1)  # [A, N, dim]
+        normalize_emb_aux = normalize_all_emb_aux[:, input_list, :]  # [A, B, dim]
+        pos_score = torch.sum(torch.mul(normalize_emb_tgt, normalize_emb_aux), dim=2)  # [A, B]
+        ttl_score = torch.matmul(normalize_emb_tgt, normalize_all_emb_aux.transpose(1, 2)).float()  # [A, B, N]
 
-    user_train = np.array(user_train)
-    beh_item_list = [np.array(beh_item) for beh_item in beh_item_list]
-    user_train = user_train[:, np.newaxis]
-    return user_train, beh_item_list
+        pos_score = torch.exp(pos_score / self.ssl_temp)
+        ttl_score = torch.sum(torch.exp(ttl_score / self.ssl_temp), dim=2)
+        if batch_indices is not None:
+            # mask_score of every behavior
+            rows, cols = batch_indices
+            masked_score = torch.sum(torch.mul(normalize_emb_tgt[rows], normalize_all_emb_aux[:, cols, :]), dim=2)
+            ttl_score = ttl_score.index_add(1, rows, 1. - torch.exp(masked_score / self.ssl_temp))
 
+        return -weighted_sum(torch.log(pos_score / ttl_score), weights)
 
-def get_train_pairs(user_train_batch, beh_item_tgt_batch):
-    input_u_list, input_i_list = [], []
-    for i in range(len(user_train_batch)):
-        pos_items = beh_item_tgt_batch[i][np.where(beh_item_tgt_batch[i] != n_items)]  # ndarray [x,]
-        uid = user_train_batch[i][0]
-        input_u_list += [uid] * len(pos_items)
-        input_i_list += pos_items.tolist()
+    def mask_score(self, ttl_score, normalize_emb_tgt, normalize_all_emb_aux, batch_indices):
+        """Count every masked (row, col) neighbor in the denominator as exp(0), i.e. as if its score were zeroed.
 
-    return np.array(input_u_list).reshape([-1]), np.array(input_i_list).reshape([-1])
+        batch_indices: (rows, cols) LongTensors of the masked entries of the [B, N] score matrix.
+        """
+        if batch_indices is None:
+            return ttl_score
+        rows, cols = batch_indices
+        masked_score = torch.sum(torch.mul(normalize_emb_tgt[rows], normalize_all_emb_aux[cols]), dim=1)
+        return ttl_score.index_add(0, rows, 1. - torch.exp(masked_score / self.ssl_temp))
 
 
 def test_torch(ua_embeddings, ia_embeddings, rela_embedding, users_to_test, batch_test_flag=False):
@@ -527,24 +669,97 @@ def test_torch(ua_embeddings, ia_embeddings, rela_embedding, users_to_test, batc
 
 
 def preprocess_sim(args, config):
-    topk1_user = args.topk1_user
-    topk1_item = args.topk1_item
+    user_indices_remove = top_k_mask(config['user_sim'], args.topk1_user)  # [n_users, n_users]
 
-    input_u_sim = torch.tensor(config['user_sim'])
-    user_topk_values1 = torch.topk(input_u_sim, min(topk1_user, config['n_users']), dim=1, largest=True)[
-        0][..., -1, None]
-    user_indices_remove = input_u_sim > user_topk_values1[..., -1, None]
-
-    input_i_sim = torch.tensor(config['item_sim'])
-    item_topk_values1 = torch.topk(input_i_sim, min(topk1_item, config['n_items']), dim=1, largest=True)[
-        0]
-    item_indices_remove = input_i_sim > item_topk_values1[..., -1, None]
-    item_indices_token = torch.tensor([False] * item_indices_remove.shape[0], dtype=torch.bool).reshape(-1, 1)
-    item_indices_remove = torch.cat([item_indices_remove, item_indices_token], dim=1)
+    item_indices_remove = top_k_mask(config['item_sim'], args.topk1_item)
+    item_indices_remove.resize((config['n_items'], config['n_items'] + 1))  # never mask the padding token
 
     return user_indices_remove, item_indices_remove
 
 
+def load_graphs(args, config):
+    """Propagation graphs of the behaviors, and the user / item similarity masks."""
+    pre_adj_list = data_generator.get_adj_mat(args.adj_type)
+    print('use the pre adjcency matrix')
+
+    if 0 < args.sim_topk < max(args.topk1_user, args.topk1_item):
+        # the similarity masks keep the topk1 largest entries of every row, which a shorter row would change
+        raise ValueError('--sim_topk {} is below --topk1_user {} / --topk1_item {}'.format(
+            args.sim_topk, args.topk1_user, args.topk1_item))
+    user_sim_mat_unified, item_sim_mat_unified = data_generator.get_unified_sim(args.sim_measure, eval(args.sim_behs),
+                                                                                args.sim_topk, args.swing_alpha)
+
+    config['user_sim'] = user_sim_mat_unified
+    config['item_sim'] = item_sim_mat_unified
+
+    user_indices, item_indices = preprocess_sim(args, config)
+    return pre_adj_list, user_indices, item_indices
+
+
+def share_graphs(args, config, local_rank):
+    """load_graphs on the local rank 0 of every host only, mapped read-only by the other workers of the host."""
+    shared = SharedArrays(local_rank)
+    graphs = load_graphs(args, config) if shared.leader else None
+    config.pop('user_sim', None)
+    config.pop('item_sim', None)
+    pre_adj_list = [shared.csr('pre_adj_%d' % i, lambda: graphs[0][i].astype(np.float32))
+                    for i in range(len(config['behs']))]
+    user_indices = shared.csr('user_indices', lambda: graphs[1])
+    item_indices = shared.csr('item_indices', lambda: graphs[2])
+    shared.close()
+    return pre_adj_list, user_indices, item_indices
+
+
+def get_mask_indices(indices_remove, batch_list, device):
+    rows, cols = indices_remove[batch_list].nonzero()
+    return to_device(rows.astype(np.int64), device), to_device(cols.astype(np.int64), device)
+
+
+def make_train_batch(train_batches, start_index, end_index, user_indices, item_indices, device, sampler=None):
+    # [B, 1], [[B, max_item1], [B, max_item2], [B, max_item3]] or [(rows, items), ...] of the CSR positives
+    u_batch, beh_batch = train_batches.batch(start_index, end_index)
+    u_batch_list, i_batch_list = train_batches.pairs(u_batch, beh_batch[-1])  # ndarray[N, ]  ndarray[N, ]
+    # the contrastive terms of a pair only depend on its user (or its item): every distinct node once, weighted by
+    # its number of pairs, and the mask rows are gathered once per node
+    u_batch_list, u_batch_weights = np.unique(u_batch_list, return_counts=True)
+    i_batch_list, i_batch_weights = np.unique(i_batch_list, return_counts=True)
+
+    # load into cuda
+    u_batch_indices = get_mask_indices(user_indices, u_batch_list, device)  # ([nnz], [nnz])
+    i_batch_indices = get_mask_indices(item_indices, i_batch_list, device)  # ([nnz], [nnz])
+    u_batch = to_device(u_batch, device)
+    if train_batches.padded:
+        beh_batch = [to_device(beh_item, device) for beh_item in beh_batch]
+        pos_items = [beh_item[beh_item != n_items] for beh_item in beh_batch]
+    else:
+        beh_batch = [(to_device(rows, device), to_device(items, device)) for rows, items in beh_batch]
+        pos_items = [items for _, items in beh_batch]
+    u_batch_list = to_device(u_batch_list, device)
+    i_batch_list = to_device(i_batch_list, device)
+    u_batch_weights = to_device(u_batch_weights.astype(np.float32), device)
+    i_batch_weights = to_device(i_batch_weights.astype(np.float32), device)
+
+    graph = None
+    if sampler is not None:
+        # receptive field of the batch users and of their positive items, with every id renumbered to its
+        # position among the seed users / seed items (the padding token comes right after the seed items)
+        seeds = torch.cat([u_batch[:, 0]] + [items + n_users for items in pos_items])
+        graph = sampler.sample(seeds)
+        n_seed_users = int(torch.searchsorted(graph.seeds, n_users))
+        seed_users, seed_items = graph.seeds[:n_seed_users], graph.seeds[n_seed_users:] - n_users
+        u_batch = local_ids(seed_users, u_batch)
+        if train_batches.padded:
+            beh_batch = [local_ids(seed_items, beh_item) for beh_item in beh_batch]
+        else:
+            beh_batch = [(rows, local_ids(seed_items, items)) for rows, items in beh_batch]
+        u_batch_list = local_ids(seed_users, u_batch_list)
+        i_batch_list = local_ids(seed_items, i_batch_list)
+        u_batch_indices = local_mask_indices(seed_users, u_batch_indices)
+        i_batch_indices = local_mask_indices(seed_items, i_batch_indices)
+    return u_batch, beh_batch, u_batch_list, i_batch_list, u_batch_weights, i_batch_weights, u_batch_indices, \
+           i_batch_indices, graph
+
+
 def set_seed(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
@@ -561,11 +776,18 @@ def set_seed(seed):
 
 
 if __name__ == '__main__':
+    if is_launcher(args.n_workers, args.n_nodes):
+        # this process only starts the workers of the host, it has not loaded the dataset
+        sys.exit(launch(args.n_workers, args.n_nodes, args.node_rank, args.master_addr, args.master_port))
+
     torch.autograd.set_detect_anomaly(True)
 
     os.environ["GIT_PYTHON_REFRESH"] = "quiet"
     os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
 
+    rank, local_rank, world_size = init_distributed(args.dist_backend)
+    if world_size > 1 and torch.cuda.is_available():
+        torch.cuda.set_device(local_rank % torch.cuda.device_count())
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     set_seed(2020)
 
@@ -575,44 +797,43 @@ if __name__ == '__main__':
     config['n_items'] = data_generator.n_items
     config['behs'] = data_generator.behs
     config['trn_mat'] = data_generator.trnMats[-1]  # 目标行为交互矩阵
+    config['trn_edges'] = data_generator.trnStore.edge_list(-1)
 
     """
     *********************************************************
     Generate the Laplacian matrix, where each entry defines the decay factor (e.g., p_ui) between two connected nodes.
     """
 
-    pre_adj_list = data_generator.get_adj_mat()
+    if world_size > 1:
+        pre_adj_list, user_indices, item_indices = share_graphs(args, config, local_rank)
+        config['shared_adjs'] = True
+        # same random state on every worker whatever it had to build
+        set_seed(2020)
+    else:
+        pre_adj_list, user_indices, item_indices = load_graphs(args, config)
     config['pre_adjs'] = pre_adj_list
-    print('use the pre adjcency matrix')
     n_users, n_items = data_generator.n_users, data_generator.n_items
     behs = data_generator.behs
     n_behs = data_generator.beh_num
 
-    user_sim_mat_unified, item_sim_mat_unified = data_generator.get_unified_sim(args.sim_measure)
-
-    config['user_sim'] = user_sim_mat_unified.todense()
-    config['item_sim'] = item_sim_mat_unified.todense()
-
-    user_indices, item_indices = preprocess_sim(args, config)
-
-    trnDicts = copy.deepcopy(data_generator.trnDicts)
-    max_item_list = []
-    beh_label_list = []
-    for i in range(n_behs):
-        max_item, beh_label = get_lables(trnDicts[i])
-        max_item_list.append(max_item)
-        beh_label_list.append(beh_label)
+    train_batches = TrainBatches(data_generator.trnStore, padded=args.rec_loss == 'padded')
+    max_item_list = train_batches.max_item_list
+    print(max_item_list)
 
     t0 = time()
 
     model = MBSSL(max_item_list, data_config=config, args=args).to(device)
     augmentor = Augmentor(data_config=config, args=args)
-    recloss = RecLoss(data_config=config, args=args).to(device)
+    recloss = (RecLoss if args.rec_loss == 'padded' else SegmentRecLoss)(data_config=config, args=args).to(device)
     ssloss = SSLoss(data_config=config, args=args).to(device)
     ssloss2 = SSLoss2(data_config=config, args=args).to(device)
 
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
-    hmg = HMG(model.parameters(), relax_factor=args.meta_r, beta=args.meta_b)
+    # with several workers every task gradient is summed over them before HMG balances it
+    hmg = HMG(model.parameters(), relax_factor=args.meta_r, beta=args.meta_b,
+              reduce_grads=all_reduce_ if world_size > 1 else None)
+    if world_size > 1:
+        broadcast_parameters(model)
     scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=args.lr_decay_step, gamma=args.lr_gamma)
     cur_best_pre_0 = 0.
     print('without pretraining.')
@@ -624,77 +845,82 @@ if __name__ == '__main__':
     stopping_step = 0
     should_stop = False
 
-    user_train1, beh_item_list = get_train_instances1(max_item_list, beh_label_list)
-
     nonshared_idx = -1
+    fanouts = eval(args.fanout)
+    fanouts = fanouts * model.n_layers if len(fanouts) == 1 else fanouts
+    # CSR arrays of the static graphs, converted once for the neighbor samplers of every epoch
+    static_csrs = {id(adj): sparse_to_csr(adj) for adj in model.pre_adjs_tensor} if args.sample_train else None
+    sub_mat_iter = augmentor.generate(args.epoch, model.n_layers, model._convert_sp_mat_to_sp_tensor,
+                                      ahead=args.aug_ahead, n_workers=args.aug_workers)
+
+    def batch_rows(idx):
+        # rows of batch idx in the epoch order, this worker's share of them
+        return shard(*train_batches.bounds(idx, args.batch_size), rank, world_size)
 
     for epoch in range(args.epoch):
         model.train()
 
-        shuffle_indices = np.random.permutation(np.arange(len(user_train1)))
-        user_train1 = user_train1[shuffle_indices]
-        beh_item_list = [beh_item[shuffle_indices] for beh_item in beh_item_list]
+        train_batches.shuffle(args.pair_budget)
 
         t1 = time()
         loss, rec_loss, emb_loss, ssl_loss, ssl2_loss = 0., 0., 0., 0., 0.
 
-        n_batch = int(len(user_train1) / args.batch_size)
+        n_batch = train_batches.n_batch(args.batch_size)
 
-        # augment the graph
+        # augment the graph, generated in the background while the previous epoch trained
         aug_time = time()
-        sub_mat = {}
-        if args.aug_type in [0, 1]:
-            sub_mat['sub1'] = model._convert_sp_mat_to_sp_tensor(augmentor.augment_adj_mat(aug_type=args.aug_type))
-            sub_mat['sub2'] = model._convert_sp_mat_to_sp_tensor(augmentor.augment_adj_mat(aug_type=args.aug_type))
-        else:
-            for k in range(1, model.n_layers + 1):
-                sub_mat['sub1%d' % k] = model._convert_sp_mat_to_sp_tensor(
-                    augmentor.augment_adj_mat(aug_type=args.aug_type))
-                sub_mat['sub2%d' % k] = model._convert_sp_mat_to_sp_tensor(
-                    augmentor.augment_adj_mat(aug_type=args.aug_type))
+        sub_mat = next(sub_mat_iter)
         # print('aug time: %.1fs' % (time() - aug_time))
 
         iter_time = time()
 
-        for idx in range(n_batch):
+        sampler = None
+        if args.sample_train:
+            # mini-batches only propagate the sampled receptive field of their users and positive items
+            sampler = NeighborSampler(model.view_adjs(sub_mat, device), fanouts,
+                                      torch.Generator(device).manual_seed(np.random.randint(1 << 31)), static_csrs)
+
+        # the next batches are built and copied to the device in the background while the current step runs; with
+        # several workers every worker takes its share of the rows of each batch
+        batch_iter = Prefetcher(lambda idx: make_train_batch(train_batches, *batch_rows(idx), user_indices, item_indices,
+                                                             device, sampler),
+                                n_batch, device, depth=args.prefetch)
+
+        for u_batch, beh_batch, u_batch_list, i_batch_list, u_batch_weights, i_batch_weights, u_batch_indices, \
+                i_batch_indices, graph in batch_iter:
             optimizer.zero_grad()
 
-            start_index = idx * args.batch_size
-            end_index = min((idx + 1) * args.batch_size, len(user_train1))
-
-            u_batch = user_train1[start_index:end_index]
-            beh_batch = [beh_item[start_index:end_index] for beh_item in
-                         beh_item_list]  # [[B, max_item1], [B, max_item2], [B, max_item3]]
-
-            u_batch_list, i_batch_list = get_train_pairs(user_train_batch=u_batch,
-                                                         beh_item_tgt_batch=beh_batch[-1])  # ndarray[N, ]  ndarray[N, ]
-
-            # load into cuda
-            u_batch = torch.from_numpy(u_batch).to(device)
-            beh_batch = [torch.from_numpy(beh_item).to(device) for beh_item in beh_batch]
-            u_batch_indices = user_indices[u_batch_list].to(device)  # [B, N]
-            i_batch_indices = item_indices[i_batch_list].to(device)  # [B, N]
-            u_batch_list = torch.from_numpy(u_batch_list).to(device)
-            i_batch_list = torch.from_numpy(i_batch_list).to(device)
-
-            model_time = time()
-            ua_embeddings, ia_embeddings, ua_embeddings_sub1, ia_embeddings_sub1, ua_embeddings_sub2, ia_embeddings_sub2, rela_embeddings, \
-            attn_user, attn_item = model(sub_mat, device)
-            # print('model time: %.1fs' % (time() - model_time))
-            # rec_loss_time = time()
-            batch_rec_loss, batch_emb_loss = recloss(u_batch, beh_batch, ua_embeddings, ia_embeddings, rela_embeddings)
-            # print('rec loss time: %.1fs' % (time() - rec_loss_time))
-            # ssl_loss_time = time()
-            batch_ssl_loss = ssloss(u_batch_list, i_batch_list, ua_embeddings_sub1[:, -1, :],
-                                    ua_embeddings_sub2[:, -1, :], ia_embeddings_sub1[:, -1, :],
-                                    ia_embeddings_sub2[:, -1, :])
-            # print('ssl loss time: %.1fs' % (time() - ssl_loss_time))
-            batch_ssl2_loss_list = []
-            for aux_beh in eval(args.aux_beh_idx):
-                aux_beh_ssl2_loss = ssloss2(u_batch_list, i_batch_list, ua_embeddings, ia_embeddings, aux_beh,
-                                            u_batch_indices, i_batch_indices)
-                batch_ssl2_loss_list.append(aux_beh_ssl2_loss)
-            batch_ssl2_loss = sum(batch_ssl2_loss_list)
+            # dense stages in bf16 with --precision bf16, sparse products and loss reductions stay in fp32
+            with torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.precision == 'bf16'):
+                model_time = time()
+                ua_embeddings, ia_embeddings, ua_embeddings_sub1, ia_embeddings_sub1, ua_embeddings_sub2, \
+                ia_embeddings_sub2, rela_embeddings, attn_user, attn_item = model(sub_mat, device, graph)
+                # print('model time: %.1fs' % (time() - model_time))
+                # rec_loss_time = time()
+                batch_rec_loss, batch_emb_loss = recloss(u_batch, beh_batch, ua_embeddings, ia_embeddings,
+                                                         rela_embeddings, world_size if graph is None else 1)
+                # print('rec loss time: %.1fs' % (time() - rec_loss_time))
+                # ssl_loss_time = time()
+                # every table the contrastive losses normalize is normalized once per forward
+                norm_cache = NormalizedEmbeddings(ua=ua_embeddings, ia=ia_embeddings,
+                                                  ua_sub2=ua_embeddings_sub2[:, -1, :],
+                                                  ia_sub2=ia_embeddings_sub2[:, -1, :])
+                batch_ssl_loss = ssloss(u_batch_list, i_batch_list, ua_embeddings_sub1[:, -1, :],
+                                        ua_embeddings_sub2[:, -1, :], ia_embeddings_sub1[:, -1, :],
+                                        ia_embeddings_sub2[:, -1, :], norm_cache, u_batch_weights, i_batch_weights)
+                # print('ssl loss time: %.1fs' % (time() - ssl_loss_time))
+                if args.ssl2_fused:
+                    batch_ssl2_loss_list = ssloss2.forward_fused(u_batch_list, i_batch_list, eval(args.aux_beh_idx),
+                                                                 u_batch_indices, i_batch_indices, norm_cache,
+                                                                 u_batch_weights, i_batch_weights)
+                else:
+                    batch_ssl2_loss_list = []
+                    for aux_beh in eval(args.aux_beh_idx):
+                        aux_beh_ssl2_loss = ssloss2(u_batch_list, i_batch_list, ua_embeddings, ia_embeddings, aux_beh,
+                                                    u_batch_indices, i_batch_indices, norm_cache, u_batch_weights,
+                                                    i_batch_weights)
+                        batch_ssl2_loss_list.append(aux_beh_ssl2_loss)
+                batch_ssl2_loss = sum(batch_ssl2_loss_list)
             batch_loss = batch_rec_loss + batch_emb_loss + batch_ssl_loss + batch_ssl2_loss
 
             if nonshared_idx == -1:
@@ -707,7 +933,10 @@ if __name__ == '__main__':
                 model.zero_grad()
 
             hmg.step([batch_rec_loss, batch_ssl_loss] + batch_ssl2_loss_list, nonshared_idx)
-            batch_emb_loss.backward()
+            if world_size > 1:
+                backward_reduced(batch_emb_loss, list(model.parameters()))
+            else:
+                batch_emb_loss.backward()
             optimizer.step()
 
             loss += batch_loss.item() / n_batch
@@ -720,18 +949,31 @@ if __name__ == '__main__':
         if args.lr_decay: scheduler.step()
         torch.cuda.empty_cache()
 
+        if world_size > 1:
+            # losses of the whole batches
+            totals = torch.tensor([loss, rec_loss, emb_loss, ssl_loss, ssl2_loss], dtype=torch.float64)
+            all_reduce_([totals])
+            loss, rec_loss, emb_loss, ssl_loss, ssl2_loss = totals.tolist()
+
         if np.isnan(loss) == True:
             print('ERROR: loss is nan.')
+            close_distributed()
             sys.exit()
 
         # print the test evaluation metrics each 10 epochs; pos:neg = 1:10.
         if (epoch + 1) % args.test_epoch != 0:
-            if args.verbose > 0 and epoch % args.verbose == 0:
+            if rank == 0 and args.verbose > 0 and epoch % args.verbose == 0:
                 perf_str = 'Epoch %d [%.1fs]: train==[%.5f=%.5f + %.5f + %.5f + %.5f]' % (
                     epoch, time() - t1, loss, rec_loss, emb_loss, ssl_loss, ssl2_loss)
                 print(perf_str)
             continue
 
+        # rank 0 evaluates and decides the early stopping of every worker
+        if rank != 0:
+            if broadcast_flag(False):
+                break
+            continue
+
         t2 = time()
         model.eval()
         with torch.no_grad():
@@ -764,9 +1006,15 @@ if __name__ == '__main__':
                                                                               flag_step=10)
         # *********************************************************
         # early stopping when cur_best_pre_0 is decreasing for ten successive steps.
+        if world_size > 1:
+            should_stop = broadcast_flag(should_stop)
         if should_stop == True:
             break
 
+    close_distributed()
+    if rank != 0:
+        sys.exit()
+
     recs = np.array(rec_loger)
     pres = np.array(pre_loger)
     ndcgs = np.array(ndcg_loger)
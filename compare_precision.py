@@ -0,0 +1,57 @@
+'''
+Train MBSSL in fp32 and in bf16 with otherwise identical arguments and report the recall / NDCG drift of bf16.
+
+Usage: python compare_precision.py [--datasets Beibei,Taobao] [any MBSSL.py argument ...]
+'''
+import argparse
+import re
+import subprocess
+import sys
+
+import numpy as np
+
+EPOCH_RE = re.compile(r'^Epoch (\d+) \[.*recall=\[([\d.]+), ([\d.]+)\].*ndcg=\[([\d.]+), ([\d.]+)\]')
+
+
+def run(dataset, precision, extra_args):
+    """Run MBSSL.py and return {epoch: [recall@K1, recall@K2, ndcg@K1, ndcg@K2]} of its evaluated epochs."""
+    cmd = [sys.executable, 'MBSSL.py', '--dataset', dataset, '--precision', precision] + extra_args
+    print(' '.join(cmd))
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    metrics = {}
+    for line in out.splitlines():
+        match = EPOCH_RE.match(line)
+        if match:
+            metrics[int(match.group(1))] = [float(x) for x in match.groups()[1:]]
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare bf16 against fp32 training.')
+    parser.add_argument('--datasets', default='Beibei,Taobao', help='Comma separated datasets')
+    args, extra_args = parser.parse_known_args()
+
+    names = ['recall@K1', 'recall@K2', 'ndcg@K1', 'ndcg@K2']
+    for dataset in args.datasets.split(','):
+        fp32 = run(dataset, 'fp32', extra_args)
+        bf16 = run(dataset, 'bf16', extra_args)
+        epochs = sorted(set(fp32) & set(bf16))
+        if not epochs:
+            print('%s: no evaluated epoch' % dataset)
+            continue
+        fp32_metrics = np.array([fp32[e] for e in epochs])
+        bf16_metrics = np.array([bf16[e] for e in epochs])
+        drift = bf16_metrics - fp32_metrics
+        best_fp32, best_bf16 = fp32_metrics.max(0), bf16_metrics.max(0)
+
+        print('%s: %d evaluated epochs' % (dataset, len(epochs)))
+        print('%-10s %10s %10s %10s %14s %14s' % ('metric', 'best fp32', 'best bf16', 'best drift', 'max |drift|',
+                                                 'mean |drift|'))
+        for j, name in enumerate(names):
+            print('%-10s %10.5f %10.5f %+10.5f %14.5f %14.5f' % (
+                name, best_fp32[j], best_bf16[j], best_bf16[j] - best_fp32[j], np.abs(drift[:, j]).max(),
+                np.abs(drift[:, j]).mean()))
+
+
+if __name__ == '__main__':
+    main()
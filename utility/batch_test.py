@@ -8,6 +8,7 @@ Wang Xiang et al. Neural Graph Collaborative Filtering. In SIGIR 2019.
 import utility.metrics as metrics
 from utility.parser import parse_args
 from utility.load_data import *
+from utility.distributed import is_launcher
 import multiprocessing
 import heapq
 
@@ -19,10 +20,14 @@ Ks = eval(args.Ks)
 # data_generator = Data(path=args.data_path + args.dataset, batch_size=args.batch_size)
 # data_generator = SBDataHandler(path=args.data_path + args.dataset, batch_size=args.batch_size)
 
-data_generator = DataHandler(dataset=args.dataset, batch_size=args.batch_size)
-# data_generator.LoadData()
-USR_NUM, ITEM_NUM = data_generator.n_users, data_generator.n_items
-N_TRAIN, N_TEST = data_generator.n_train, data_generator.n_test
+# the process launching the data-parallel workers only waits for them, the workers load the dataset
+if not is_launcher(args.n_workers, args.n_nodes):
+    data_generator = DataHandler(dataset=args.dataset, batch_size=args.batch_size, use_cache=args.data_cache,
+                                 data_source=args.data_source, stream_chunk=args.stream_chunk << 20,
+                                 spill_items=(args.spill_mb << 20) // 4, check_data=args.check_data)
+    # data_generator.LoadData()
+    USR_NUM, ITEM_NUM = data_generator.n_users, data_generator.n_items
+    N_TRAIN, N_TEST = data_generator.n_train, data_generator.n_test
 if args.dataset == 'amazon-book':
     BATCH_SIZE = args.batch_size // 4
 else:
@@ -100,16 +105,13 @@ def test_one_user(x):
     # uid
     u = x[1]  # [1, ]
     # user u's items in the training set
-    try:
-        training_items = data_generator.train_items[u]
-    except Exception:
-        training_items = []
+    training_items = data_generator.trnStore.items(u)
     # user u's items in the test set
-    user_pos_test = data_generator.test_set[u]
+    user_pos_test = data_generator.tstStore.items(u).tolist()
 
-    all_items = set(range(ITEM_NUM))
-
-    test_items = list(all_items - set(training_items))
+    test_mask = np.ones(ITEM_NUM, dtype=bool)
+    test_mask[training_items] = False
+    test_items = np.flatnonzero(test_mask).tolist()
 
     if args.test_flag == 'part':
         r, auc = ranklist_by_heapq(user_pos_test, test_items, rating, Ks)
@@ -128,11 +130,9 @@ def test_one_user_train(x):
 
     training_items = []
     # user u's items in the test set
-    user_pos_test = data_generator.train_items[u]
-
-    all_items = set(range(ITEM_NUM))
+    user_pos_test = data_generator.trnStore.items(u).tolist()
 
-    test_items = list(all_items - set(training_items))
+    test_items = list(range(ITEM_NUM))
 
     if args.test_flag == 'part':
         r, auc = ranklist_by_heapq(user_pos_test, test_items, rating, Ks)
@@ -0,0 +1,113 @@
+'''
+Vectorized construction of the training batches: padded per-behavior label arrays (or the untruncated CSR
+positives) and the (user, item) pairs of the target behavior, built straight from the CSR arrays of an
+InteractionStore.
+'''
+import numpy as np
+
+
+def label_length(degrees, k=0.9999):
+    """Label width of a behavior: the k-quantile of the degrees of the users that have interactions."""
+    item_lenth = np.sort(degrees[degrees > 0])
+    return int(item_lenth[int(len(item_lenth) * k) - 1])
+
+
+def padded_labels(indptr, indices, users, max_item, pad):
+    """[len(users), max_item] array of the first max_item items of every user, padded with ``pad``."""
+    starts = indptr[users]
+    deg = np.minimum(indptr[users + 1] - starts, max_item)
+    rows = np.repeat(np.arange(len(users)), deg)
+    cols = np.arange(len(rows)) - np.repeat(np.cumsum(deg) - deg, deg)
+    labels = np.full((len(users), max_item), pad, dtype=np.int64)
+    labels[rows, cols] = indices[np.repeat(starts, deg) + cols]
+    return labels
+
+
+def csr_positives(indptr, indices, users):
+    """All the items of ``users``: (rows, items) int64 arrays, rows indexing ``users``, in CSR order."""
+    starts = indptr[users]
+    deg = indptr[users + 1] - starts
+    rows = np.repeat(np.arange(len(users)), deg)
+    items = indices[np.repeat(starts - (np.cumsum(deg) - deg), deg) + np.arange(len(rows))]
+    return rows, items.astype(np.int64)
+
+
+class TrainBatches(object):
+    """Training users (those with target interactions) with their padded labels in every behavior, or with
+    ``padded`` False their CSR positives, which keep every item of the heavy users.
+
+    The arrays are built once; an epoch shuffles an index permutation and batches gather their rows from it,
+    so no padded array is copied per epoch. Batches are either ``batch_size`` consecutive users of the permutation
+    or, with a pair budget, groups of users of similar target degree holding at most that many target pairs.
+    """
+
+    def __init__(self, store, k=0.9999, padded=True):
+        self.pad = store.n_items
+        self.padded = padded
+        self.users = store.users(-1)
+        self.max_item_list = [label_length(store.degrees(beh), k) for beh in range(len(store))]
+        if padded:
+            self.labels = [padded_labels(store.indptrs[beh], store.indices[beh], self.users, max_item, self.pad)
+                           for beh, max_item in enumerate(self.max_item_list)]
+        else:
+            self.csrs = list(zip(store.indptrs, store.indices))
+        # target pairs of every user, as given by pairs()
+        self.n_pairs = store.degrees(-1)[self.users]
+        if padded:
+            self.n_pairs = np.minimum(self.n_pairs, self.max_item_list[-1])
+        self.order = np.arange(len(self.users))
+        self.offsets = None
+
+    def __len__(self):
+        return len(self.users)
+
+    def shuffle(self, pair_budget=0):
+        """New epoch order. With a ``pair_budget``, it is also cut into batches of at most that many target pairs
+        (or a single user): users are bucketed by the power of two of their pair count, every bucket is cut into
+        batches of budget // (its largest count) users, so a batch is at least half full, and the batches of all
+        the buckets are shuffled. Every user is in exactly one batch."""
+        # permute the previous order, as the training users were shuffled in place epoch after epoch
+        self.order = self.order[np.random.permutation(len(self.users))]
+        if pair_budget <= 0:
+            self.offsets = None
+            return
+
+        bucket = np.log2(self.n_pairs[self.order]).astype(np.int64)
+        batches = []
+        for b in np.unique(bucket):
+            rows = self.order[bucket == b]
+            size = max(1, pair_budget // int(self.n_pairs[rows].max()))
+            batches += np.split(rows, np.arange(size, len(rows), size))
+        batches = [batches[i] for i in np.random.permutation(len(batches))]
+        self.order = np.concatenate(batches)
+        self.offsets = np.cumsum([0] + [len(rows) for rows in batches])
+
+    def n_batch(self, batch_size):
+        """Batches of the epoch: the pair-budget batches, else the full batches of ``batch_size`` users (the
+        trailing partial batch is dropped)."""
+        if self.offsets is not None:
+            return len(self.offsets) - 1
+        return len(self.users) // batch_size
+
+    def bounds(self, idx, batch_size):
+        """[start, end) of batch idx in the epoch order."""
+        if self.offsets is not None:
+            return self.offsets[idx], self.offsets[idx + 1]
+        return idx * batch_size, min((idx + 1) * batch_size, len(self.users))
+
+    def batch(self, start, end):
+        """Users [B, 1] and labels [[B, max_item1], [B, max_item2], ...] of rows start:end of the epoch order,
+        or their positives [(rows, items), ...] when not padded."""
+        users = self.users[self.order[start:end]]
+        if not self.padded:
+            return users[:, np.newaxis], [csr_positives(indptr, indices, users) for indptr, indices in self.csrs]
+        rows = self.order[start:end]
+        return users[:, np.newaxis], [labels[rows] for labels in self.labels]
+
+    def pairs(self, u_batch, tgt_batch):
+        """(user, item) pairs [N,], [N,] of the target labels (or positives) of a batch, in row-major order."""
+        if not self.padded:
+            rows, items = tgt_batch
+            return u_batch[rows, 0], items
+        valid = tgt_batch != self.pad
+        return np.repeat(u_batch[:, 0], valid.sum(1)), tgt_batch[valid]
@@ -0,0 +1,44 @@
+'''
+Helpers of the contrastive losses: the L2-normalized embedding tables of a forward, and bounded-memory InfoNCE
+denominators (the full-softmax log-partition of a batch of queries against a whole embedding table, streamed
+over blocks of the table).
+'''
+import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+def _block_logsumexp(query, keys, temp):
+    scores = torch.matmul(query, F.normalize(keys, dim=1).T).float()
+    return torch.logsumexp(scores / temp, dim=1)
+
+
+def chunked_logsumexp(query, keys, temp, chunk=8192):
+    """log sum_j exp(query . normalize(keys[j]) / temp) for every row of the [B, dim] ``query``, [B,].
+
+    The [N, dim] ``keys`` are normalized and scored ``chunk`` rows at a time, and every block is recomputed in
+    backward instead of being kept, so memory is O(B * chunk) whatever N; the per-block results are combined with
+    a stable logsumexp, which does not overflow at low temperatures.
+    """
+    # split, not slices: the gradient of a slice would be a full [N, dim] tensor per block
+    lse = [checkpoint(_block_logsumexp, query, block, temp, use_reentrant=False) for block in keys.split(chunk)]
+    return torch.logsumexp(torch.stack(lse, dim=1), dim=1)
+
+
+def weighted_sum(values, weights=None):
+    """Sum of ``values`` along the last dimension, every entry counted ``weights`` times (once if None)."""
+    return torch.sum(values if weights is None else values * weights, dim=-1)
+
+
+class NormalizedEmbeddings(object):
+    """L2-normalized (along the last dimension) embedding tables of one forward, each normalized on first use
+    and then shared by every loss that needs it."""
+
+    def __init__(self, **tables):
+        self.tables = tables
+        self.normalized = {}
+
+    def __getitem__(self, name):
+        if name not in self.normalized:
+            self.normalized[name] = F.normalize(self.tables[name], dim=-1)
+        return self.normalized[name]
@@ -0,0 +1,144 @@
+'''
+Data-parallel training over torch.distributed: launching the workers, summing their gradients, and read-only
+arrays shared by the workers of a host through memory-mapped files.
+'''
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import warnings
+from datetime import timedelta
+
+import numpy as np
+import scipy.sparse as sp
+import torch
+import torch.distributed as dist
+
+# rank 0 evaluates alone while the other workers wait in a collective
+TIMEOUT = timedelta(hours=2)
+
+
+def launch(n_workers, n_nodes=1, node_rank=0, master_addr='127.0.0.1', master_port=29500):
+    """Run this script in ``n_workers`` processes on host ``node_rank`` of ``n_nodes``, with the environment
+    variables of torchrun (RANK, LOCAL_RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT). Waits for all of them, and
+    stops the others when one fails. Returns the first nonzero exit code, else 0."""
+    world_size = n_workers * n_nodes
+    procs = []
+    for local_rank in range(n_workers):
+        env = dict(os.environ, RANK=str(node_rank * n_workers + local_rank), LOCAL_RANK=str(local_rank),
+                   WORLD_SIZE=str(world_size), MASTER_ADDR=master_addr, MASTER_PORT=str(master_port))
+        procs.append(subprocess.Popen([sys.executable] + sys.argv, env=env))
+    code = 0
+    while any(p.poll() is None for p in procs):
+        code = code or next((p.returncode for p in procs if p.returncode), 0)
+        if code:
+            for p in procs:
+                if p.poll() is None:
+                    p.terminate()
+        time.sleep(1)
+    return code or next((p.returncode for p in procs if p.returncode), 0)
+
+
+def is_launcher(n_workers, n_nodes=1):
+    """Whether this process only launches the workers of its host (several workers, not started as one)."""
+    return n_workers * n_nodes > 1 and 'WORLD_SIZE' not in os.environ
+
+
+def init_distributed(backend='gloo'):
+    """Join the process group described by the torchrun environment. Returns (rank, local rank, world size),
+    (0, 0, 1) when the script was not launched as a worker."""
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 0, 1
+    dist.init_process_group(backend, timeout=TIMEOUT)
+    return dist.get_rank(), int(os.environ.get('LOCAL_RANK', 0)), world_size
+
+
+def close_distributed():
+    """Leave the process group, if this process joined one."""
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def shard(start, end, rank, world_size):
+    """Rows of [start, end) taken by worker ``rank``."""
+    n = end - start
+    return start + n * rank // world_size, start + n * (rank + 1) // world_size
+
+
+def all_reduce_(tensors):
+    """Sum ``tensors`` over the workers, in place, with a single collective."""
+    if not tensors:
+        return
+    flat = torch.cat([t.reshape(-1) for t in tensors])
+    dist.all_reduce(flat)
+    for t, reduced in zip(tensors, torch.split(flat, [t.numel() for t in tensors])):
+        t.copy_(reduced.view_as(t))
+
+
+def backward_reduced(loss, params):
+    """``loss.backward()`` with the gradient summed over the workers before it is accumulated into the
+    (already reduced) gradients of ``params``."""
+    grads = torch.autograd.grad(loss, params, allow_unused=True)
+    grads = [(p, g) for p, g in zip(params, grads) if g is not None]
+    all_reduce_([g for _, g in grads])
+    for p, g in grads:
+        p.grad = g if p.grad is None else p.grad + g
+
+
+def broadcast_parameters(module):
+    """Copy the parameters of rank 0 to every worker."""
+    for p in module.parameters():
+        dist.broadcast(p.data, 0)
+
+
+def broadcast_flag(flag):
+    """Value of ``flag`` on rank 0, on every worker."""
+    flag = torch.tensor([int(flag)])
+    dist.broadcast(flag, 0)
+    return bool(flag.item())
+
+
+class SharedArrays(object):
+    """Read-only arrays written once per host by its local rank 0, in a per-run directory of the shared memory
+    file system, and memory-mapped by every worker of the host, so they share the pages instead of holding a
+    copy each."""
+
+    def __init__(self, local_rank):
+        self.leader = local_rank == 0
+        token = [uuid.uuid4().hex]
+        dist.broadcast_object_list(token, 0)
+        root = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.path = os.path.join(root, 'mbssl-%s' % token[0])
+        if self.leader:
+            os.makedirs(self.path, exist_ok=True)
+
+    def csr(self, name, build):
+        """CSR matrix ``name``: ``build()`` on the local leader, the shared copy on every worker."""
+        keys = ['data', 'indices', 'indptr', 'shape']
+        if self.leader:
+            mat = sp.csr_matrix(build())
+            for key, array in zip(keys, [mat.data, mat.indices, mat.indptr, np.array(mat.shape)]):
+                np.save(os.path.join(self.path, '%s.%s.npy' % (name, key)), array)
+        dist.barrier()
+        data, indices, indptr, shape = [np.load(os.path.join(self.path, '%s.%s.npy' % (name, key)), mmap_mode='r')
+                                        for key in keys]
+        return sp.csr_matrix((data, indices, indptr), shape=tuple(shape), copy=False)
+
+    def close(self):
+        """Remove the files once every worker has mapped them; the mappings stay valid."""
+        dist.barrier()
+        if self.leader:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+def csr_tensor(mat):
+    """Sparse CSR tensor over the arrays of the scipy CSR ``mat``, without copying them."""
+    with warnings.catch_warnings():
+        # the memory-mapped arrays are read-only (nothing writes to them), and CSR tensors are in beta
+        warnings.simplefilter('ignore', UserWarning)
+        arrays = [torch.from_numpy(array) for array in [mat.indptr, mat.indices, mat.data]]
+        return torch.sparse_csr_tensor(*arrays, size=mat.shape)
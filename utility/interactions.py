@@ -0,0 +1,103 @@
+'''
+CSR-backed user-item interaction store shared by the data handler, the samplers and the evaluation workers.
+'''
+from collections.abc import Mapping
+
+import numpy as np
+import scipy.sparse as sp
+
+
+class InteractionStore(object):
+    """Per-behavior user -> item adjacency held as CSR arrays.
+
+    Row u of behavior b is ``indices[b][indptr[b][u]:indptr[b][u + 1]]``, sorted ascending, so degrees are
+    O(1) and membership tests are a binary search. The arrays may be read-only memory maps, in which case
+    every process that opens (or forks after opening) the store reads the same physical pages. ``edges``
+    optionally keeps, per behavior, the (users, items) edge list in input order (None where it is not kept).
+    """
+
+    def __init__(self, indptrs, indices, n_items, edges=None):
+        self.indptrs = list(indptrs)
+        self.indices = list(indices)
+        self.edges = list(edges) if edges is not None else [None] * len(self.indptrs)
+        self.n_users = len(self.indptrs[0]) - 1
+        self.n_items = n_items
+
+    @classmethod
+    def from_csr(cls, mats):
+        mats = [sp.csr_matrix(mat) for mat in mats]
+        for mat in mats:
+            mat.sum_duplicates()
+        return cls([mat.indptr for mat in mats], [mat.indices for mat in mats], mats[0].shape[1])
+
+    def __len__(self):
+        return len(self.indptrs)
+
+    def items(self, u, beh=-1):
+        indptr = self.indptrs[beh]
+        return self.indices[beh][indptr[u]:indptr[u + 1]]
+
+    def degree(self, u, beh=-1):
+        indptr = self.indptrs[beh]
+        return int(indptr[u + 1] - indptr[u])
+
+    def degrees(self, beh=-1):
+        return np.diff(self.indptrs[beh])
+
+    def users(self, beh=-1):
+        return np.flatnonzero(self.degrees(beh))
+
+    def contains(self, u, items, beh=-1):
+        """Whether ``items`` (a scalar or an array) are neighbors of user ``u`` in behavior ``beh``."""
+        row = self.items(u, beh)
+        if len(row) == 0:
+            return np.zeros(np.shape(items), dtype=bool)
+        pos = np.minimum(np.searchsorted(row, items), len(row) - 1)
+        return row[pos] == items
+
+    def to_csr(self, beh=-1):
+        indices = self.indices[beh]
+        return sp.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, self.indptrs[beh]),
+                             shape=(self.n_users, self.n_items))
+
+    def edge_list(self, beh=-1):
+        """(users, items) of behavior ``beh``, in input order where it is kept, else row by row."""
+        if self.edges[beh] is not None:
+            return self.edges[beh]
+        indptr = self.indptrs[beh]
+        return np.repeat(np.arange(self.n_users), np.diff(indptr)), np.asarray(self.indices[beh])
+
+    def view(self, beh=-1):
+        return BehaviorView(self, beh)
+
+
+class BehaviorView(Mapping):
+    """Read-only ``{uid: items}`` mapping over one behavior of an InteractionStore.
+
+    Drop-in replacement for the former dict-of-lists: users without interactions are not keys, and values
+    are array slices into the store (no per-user Python objects are kept).
+    """
+
+    def __init__(self, store, beh):
+        self.store = store
+        self.beh = beh
+        self._users = None
+
+    def keys_array(self):
+        if self._users is None:
+            self._users = self.store.users(self.beh)
+        return self._users
+
+    def __getitem__(self, u):
+        if not 0 <= u < self.store.n_users or self.store.degree(u, self.beh) == 0:
+            raise KeyError(u)
+        return self.store.items(u, self.beh)
+
+    def __contains__(self, u):
+        return 0 <= u < self.store.n_users and self.store.degree(u, self.beh) > 0
+
+    def __iter__(self):
+        return iter(self.keys_array().tolist())
+
+    def __len__(self):
+        return len(self.keys_array())
@@ -10,13 +10,319 @@ import numpy as np
 import random as rd
 import scipy.sparse as sp
 from time import time
+import hashlib
+import pickle
+import shutil
+import tempfile
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from utility.interactions import InteractionStore
+from utility.similarity import build_sim_mat, top_k_rows
+
+CACHE_VERSION = 'csr-2'
+CSR_PARTS = ['indptr', 'indices']
+# target-behavior edge list in input order
+EDGE_PARTS = ['rows', 'cols']
+# binary counterparts of the text files, other behaviors are stored as trn_<beh>
+BIN_FILES = {'train': 'trn_buy', 'test': 'tst_int'}
+
+
+def read_inter_file(file_name, skip_invalid=False):
+    """Parse a ``uid item item ...`` interaction file in a single pass.
+
+    Returns a line-major CSR of the file: the user id of every line, the offsets of every line into the
+    flat item array, and the flat item array itself (items keep their order in the file).
+    """
+    with open(file_name) as f:
+        uids, counts, indices = parse_lines(f, skip_invalid)
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return uids, indptr, indices
+
+
+def parse_lines(lines, skip_invalid=False):
+    """Parse ``uid item item ...`` lines into the user id, the item count and the flat items of every line."""
+    uids, counts, tokens = [], [], []
+    for l in lines:
+        l = l.strip('\n')
+        if len(l) == 0:
+            continue
+        row = l.split(' ')
+        if skip_invalid:
+            try:
+                [int(i) for i in row]
+            except Exception:
+                continue
+        uids.append(row[0])
+        counts.append(len(row) - 1)
+        tokens.extend(row[1:])
+    uids = np.array(uids, dtype=np.int64).astype(np.int32)
+    counts = np.array(counts, dtype=np.int64)
+    indices = np.array(tokens, dtype=np.int64).astype(np.int32)
+    return uids, counts, indices
+
+
+class GrowableArray(object):
+    """Append-only numpy buffer that doubles its capacity, so appends are amortized O(1)."""
+
+    def __init__(self, dtype, capacity=1 << 16):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        if self.size + len(values) > len(self.data):
+            data = np.empty(max(2 * len(self.data), self.size + len(values)), dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:self.size + len(values)] = values
+        self.size += len(values)
+
+    def array(self):
+        return self.data[:self.size]
+
+    def clear(self):
+        self.size = 0
+
+
+def stream_inter_file(file_name, work_dir, skip_invalid=False, chunk_size=64 << 20, spill_items=1 << 28):
+    """Parse an interaction file in chunks of ``chunk_size`` bytes into int32 line buffers.
+
+    Whenever the buffered items reach ``spill_items`` the buffers are written to ``work_dir`` and reused, so
+    peak memory is bounded by the chunk and spill sizes instead of the file size. Returns the spilled parts,
+    each a ``(uids, counts, indices)`` tuple of memory-mapped arrays.
+    """
+    uids, counts, indices = GrowableArray(np.int32), GrowableArray(np.int64), GrowableArray(np.int32)
+    parts = []
+
+    def append(text):
+        for buf, values in zip([uids, counts, indices], parse_lines(text.split('\n'), skip_invalid)):
+            buf.extend(values)
+
+    def spill():
+        prefix = os.path.join(work_dir, '%s_part%d_' % (os.path.basename(file_name), len(parts)))
+        part = []
+        for name, buf in zip(['uids', 'counts', 'indices'], [uids, counts, indices]):
+            np.save(prefix + name + '.npy', buf.array())
+            part.append(np.load(prefix + name + '.npy', mmap_mode='r'))
+            buf.clear()
+        parts.append(tuple(part))
+
+    # a chunk ends at its last newline, the partial line is carried over to the next chunk
+    rest = b''
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            chunk = rest + chunk
+            end = chunk.rfind(b'\n') + 1
+            rest = chunk[end:]
+            append(chunk[:end].decode())
+            if indices.size >= spill_items:
+                spill()
+    append(rest.decode())
+    spill()
+    return parts
+
+
+def alloc_array(work_dir, name, size, dtype):
+    if work_dir is None:
+        return np.empty(size, dtype=dtype)
+    return np.lib.format.open_memmap(os.path.join(work_dir, name + '.npy'), mode='w+', dtype=dtype, shape=(size,))
+
+
+def merge_lines_to_csr(parts, n_users, work_dir=None, name='csr', block_items=1 << 28):
+    """Merge ``(uids, counts, indices)`` line parts into user CSR arrays ``(indptr, indices)`` with sorted,
+    de-duplicated rows.
+
+    Items are scattered to their rows by a counting pass per part, then every block of about ``block_items``
+    items is sorted and de-duplicated on its own. With a ``work_dir`` the outputs are memory maps in it, so
+    peak memory is bounded by the part and block sizes.
+    """
+    deg = np.zeros(n_users, dtype=np.int64)
+    for uids, counts, _ in parts:
+        deg += np.bincount(np.repeat(uids, counts), minlength=n_users)
+    indptr = np.zeros(n_users + 1, dtype=np.int64)
+    np.cumsum(deg, out=indptr[1:])
+
+    grouped = alloc_array(work_dir, name + '_grouped', indptr[-1], np.int32)
+    fill = indptr[:-1].copy()
+    for uids, counts, indices in parts:
+        users = np.repeat(uids, counts)
+        order = np.argsort(users, kind='stable')
+        users = users[order]
+        rank = np.arange(len(users)) - np.searchsorted(users, users)
+        grouped[fill[users] + rank] = indices[order]
+        fill += np.bincount(users, minlength=n_users)
+
+    csr_indices = alloc_array(work_dir, name + '_indices', indptr[-1], np.int32)
+    csr_deg = np.zeros(n_users, dtype=np.int64)
+    bounds = np.unique(np.searchsorted(indptr, np.arange(0, indptr[-1], block_items), side='right') - 1)
+    bounds = np.append(bounds, n_users)
+    nnz = 0
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        # (row, item) packed into one int64 key, so a plain sort orders rows and items at once
+        keys = np.repeat(np.arange(end - start, dtype=np.int64) << 32, deg[start:end])
+        keys |= grouped[indptr[start]:indptr[end]]
+        keys.sort()
+        keep = np.ones(len(keys), dtype=bool)
+        keep[1:] = keys[1:] != keys[:-1]
+        keys = keys[keep]
+        csr_indices[nnz:nnz + len(keys)] = keys & 0xffffffff
+        csr_deg[start:end] = np.bincount(keys >> 32, minlength=end - start)
+        nnz += len(keys)
+    csr_indptr = np.zeros(n_users + 1, dtype=np.int64)
+    np.cumsum(csr_deg, out=csr_indptr[1:])
+    return csr_indptr, csr_indices[:nnz]
+
+
+def input_order_edges(parts):
+    """(rows, cols) int32 edge list of ``(uids, counts, indices)`` line parts in input order, a repeated pair kept
+    at its first occurrence, as the DOK matrix the text files used to be read into."""
+    rows = np.concatenate([np.repeat(uids, counts) for uids, counts, _ in parts])
+    cols = np.concatenate([indices for _, _, indices in parts])
+    keys = (rows.astype(np.int64) << 32) | cols
+    first = np.sort(np.unique(keys, return_index=True)[1])
+    return rows[first], cols[first]
+
+
+def read_bin_file(file_name, is_test=False):
+    """Read a pickled ``trn_*`` matrix or the ``tst_int`` list (test item(s) or None per user) into the same
+    line-major CSR as read_inter_file, with one line per user."""
+    with open(file_name, 'rb') as f:
+        data = pickle.load(f)
+    if is_test:
+        uids, counts, items = [], [], []
+        for uid, test_items in enumerate(data):
+            if test_items is None:
+                continue
+            test_items = np.atleast_1d(test_items)
+            uids.append(uid)
+            counts.append(len(test_items))
+            items.append(test_items)
+        indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        # no user with test items gives an empty store
+        items = np.concatenate(items) if items else np.zeros(0)
+        return np.array(uids, dtype=np.int32), indptr, items.astype(np.int32)
+
+    mat = sp.csr_matrix(data)
+    mat.sum_duplicates()
+    return np.arange(mat.shape[0], dtype=np.int32), mat.indptr.astype(np.int64), mat.indices.astype(np.int32)
+
+
+def read_src_file(src_file, is_test=False):
+    if src_file.endswith('.txt'):
+        return read_inter_file(src_file, skip_invalid=is_test)
+    return read_bin_file(src_file, is_test)
+
+
+def compile_data(src_files, stream_chunk=0, spill_items=1 << 28, work_dir=None):
+    """Read the behavior files (train last) and the test file (last), text or binary, into per-file user CSR
+    arrays ``(indptr, indices)``, the train edges in input order, and the ``[n_users, n_items, n_train, n_test,
+    *interNum]`` meta array.
+
+    With ``stream_chunk`` > 0 the text files are streamed in chunks of that many bytes and spilled to
+    ``work_dir``, which then also holds the merged CSR arrays.
+    """
+    sources = []
+    for idx, src_file in enumerate(src_files):
+        is_test = idx == len(src_files) - 1
+        if stream_chunk > 0 and src_file.endswith('.txt'):
+            sources.append(stream_inter_file(src_file, work_dir, is_test, stream_chunk, spill_items))
+        else:
+            uids, indptr, indices = read_src_file(src_file, is_test)
+            sources.append([(uids, np.diff(indptr), indices)])
+
+    n_users = max(int(uids.max()) for parts in sources[:-1] for uids, _, _ in parts if len(uids) > 0) + 1
+    n_items = max(int(indices.max()) for parts in sources for _, _, indices in parts if len(indices) > 0) + 1
+    inter_num = [sum(len(indices) for _, _, indices in parts) for parts in sources]
+    meta = np.array([n_users, n_items, inter_num[-2], inter_num[-1]] + inter_num[:-1], dtype=np.int64)
+
+    csrs = [merge_lines_to_csr(parts, n_users, work_dir, 'csr%d' % idx, spill_items)
+            for idx, parts in enumerate(sources)]
+    return csrs, input_order_edges(sources[-2]), meta
+
+
+def check_compiled_data(csrs, meta, ref_csrs, ref_edges, ref_meta):
+    # the edge order of a binary file is its own, only the interactions are compared
+    if not np.array_equal(meta, ref_meta):
+        raise ValueError('Binary dataset meta {} differs from the text files {}'.format(meta.tolist(),
+                                                                                     ref_meta.tolist()))
+    for idx, ((indptr, indices), (ref_indptr, ref_indices)) in enumerate(zip(csrs, ref_csrs)):
+        if not (np.array_equal(indptr, ref_indptr) and np.array_equal(indices, ref_indices)):
+            raise ValueError('Binary dataset file {} differs from its text file'.format(idx))
+
+
+def hash_files(file_names):
+    h = hashlib.sha1(CACHE_VERSION.encode())
+    for file_name in file_names:
+        h.update(os.path.basename(file_name).encode())
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 22), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+def stat_key(file_names):
+    h = hashlib.sha1(CACHE_VERSION.encode())
+    for file_name in file_names:
+        st = os.stat(file_name)
+        h.update(('%s:%d:%d;' % (os.path.abspath(file_name), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+def cached_hash_files(file_names, index_dir):
+    """hash_files of ``file_names``, memoized in ``index_dir`` under their paths, sizes and modification times, so
+    a warm start only stats the files; their content is hashed again only when one of those changes."""
+    index_file = os.path.join(index_dir, 'stat_' + stat_key(file_names))
+    try:
+        with open(index_file) as f:
+            digest = f.read().strip()
+        if len(digest) == hashlib.sha1().digest_size * 2:
+            return digest
+    except OSError:
+        pass
+    digest = hash_files(file_names)
+    tmp_file = '%s.tmp%d' % (index_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        f.write(digest)
+    os.replace(tmp_file, index_file)
+    return digest
+
+
+def save_compiled_data(path, names, csrs, edges, meta):
+    # write into a private directory and rename it, so concurrent runs never see a partial cache
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, arrays in zip(names, csrs):
+        for part, array in zip(CSR_PARTS, arrays):
+            np.save(os.path.join(tmp_path, '%s_%s.npy' % (name, part)), array)
+    for part, array in zip(EDGE_PARTS, edges):
+        np.save(os.path.join(tmp_path, '%s_%s.npy' % (names[-2], part)), array)
+    np.save(os.path.join(tmp_path, 'meta.npy'), meta)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_compiled_data(path, names):
+    csrs = [tuple(np.load(os.path.join(path, '%s_%s.npy' % (name, part)), mmap_mode='r') for part in CSR_PARTS)
+            for name in names]
+    edges = tuple(np.load(os.path.join(path, '%s_%s.npy' % (names[-2], part)), mmap_mode='r') for part in EDGE_PARTS)
+    meta = np.load(os.path.join(path, 'meta.npy'))
+    return csrs, edges, meta
 
 
 class DataHandler(object):
-    def __init__(self, dataset, batch_size):
+    def __init__(self, dataset, batch_size, use_cache=True, data_source='txt', stream_chunk=0, spill_items=1 << 28,
+                 check_data=False):
         self.dataset_name = dataset
         self.batch_size = batch_size
+        self.use_cache = use_cache
+        self.check_data = check_data
+        self.data_source = data_source
+        self.stream_chunk = stream_chunk
+        self.spill_items = spill_items
         if self.dataset_name.find('Taobao') != -1 or self.dataset_name.find('Beibei') != -1:
             behs = ['pv', 'cart', 'train']
         elif self.dataset_name.find('yelp') != -1:
@@ -58,201 +364,160 @@ class DataHandler(object):
         os.makedirs(self.saveSimMatPath, exist_ok=True)
 
     def LoadData(self):
-        for i in range(len(self.behs) - 1):
-            beh = self.behs[i]
-            file_name = self.predir + '/' + beh + '.txt'
-            with open(file_name) as f:
-                for l in f.readlines():
-                    if len(l) > 0:
-                        l = l.strip('\n').split(' ')
-                        items = [int(i) for i in l[1:]]
-                        uid = int(l[0])
-                        self.n_items = max(self.n_items, max(items))
-                        self.n_users = max(self.n_users, uid)
-
-        train_file = self.predir + '/train.txt'
-        test_file = self.predir + '/test.txt'
-        with open(train_file) as f:
-            for l in f.readlines():
-                if len(l) > 0:
-                    l = l.strip('\n').split(' ')
-                    items = [int(i) for i in l[1:]]
-                    uid = int(l[0])
-                    self.exist_users.append(uid)
-                    self.n_items = max(self.n_items, max(items))
-                    self.n_users = max(self.n_users, uid)
-                    self.n_train += len(items)
-
-        with open(test_file) as f:
-            for l in f.readlines():
-                if len(l) > 0:
-                    l = l.strip('\n')
-                    try:
-                        items = [int(i) for i in l.split(' ')[1:]]
-                    except Exception:
-                        continue
-                    self.n_items = max(self.n_items, max(items))
-                    self.n_test += len(items)
-        self.n_items += 1
-        self.n_users += 1
-
-        self.trnMats = [sp.dok_matrix((self.n_users, self.n_items), dtype=np.float32) for i in
-                        range(len(self.behs))]
-        self.tstMats = sp.dok_matrix((self.n_users, self.n_items), dtype=np.float32)
-        self.trnDicts = [dict() for i in range(len(self.behs))]
+        csrs, edges, meta = self.load_compiled()
+        self.n_users, self.n_items, self.n_train, self.n_test = [int(x) for x in meta[:4]]
+        self.interNum = [int(x) for x in meta[4:]]
+
+        # the train edges keep the order of the file, which the augmentations draw from
+        self.trnStore = InteractionStore([indptr for indptr, _ in csrs[:-1]], [indices for _, indices in csrs[:-1]],
+                                         self.n_items, edges=[None] * (len(self.behs) - 1) + [edges])
+        self.tstStore = InteractionStore([csrs[-1][0]], [csrs[-1][1]], self.n_items)
+        self.exist_users = self.trnStore.users(-1).tolist()
+
+        self.trnMats = [self.trnStore.to_csr(i) for i in range(len(self.behs))]
+        self.tstMats = self.tstStore.to_csr()
+        self.trnDicts = [self.trnStore.view(i) for i in range(len(self.behs))]
         self.trnDicts_item = [dict() for i in range(len(self.behs))]
-        self.tstDicts = dict()
-        self.interNum = [0 for i in range(len(self.behs))]
-        for i in range(len(self.behs) - 1):
-            beh = self.behs[i]
-            beh_filename = self.predir + '/' + beh + '.txt'
-            with open(beh_filename) as f:
-                for l in f.readlines():
-                    if len(l) == 0: break
-                    l = l.strip('\n')
-                    items = [int(i) for i in l.split(' ')]
-                    uid, items_list = items[0], items[1:]
-                    self.interNum[i] += len(items_list)
-                    for item in items_list:
-                        self.trnMats[i][uid, item] = 1.
-                    self.trnDicts[i][uid] = items_list
-        with open(train_file) as f:
-            for l in f.readlines():
-                if len(l) == 0: break
-                l = l.strip('\n')
-                items = [int(i) for i in l.split(' ')]
-                uid, train_items = items[0], items[1:]
-                self.interNum[-1] += len(train_items)
-                for i in train_items:
-                    self.trnMats[-1][uid, i] = 1.
-
-                self.trnDicts[-1][uid] = train_items
-        with open(test_file) as f:
-            for l in f.readlines():
-                if len(l) == 0: break
-                l = l.strip('\n')
-                try:
-                    items = [int(i) for i in l.split(' ')]
-                except Exception:
-                    continue
-                uid, test_items = items[0], items[1:]
-
-                for i in test_items:
-                    self.tstMats[uid, i] = 1.
-                self.tstDicts[uid] = test_items
+        self.tstDicts = self.tstStore.view()
+
         self.print_statistics()
         self.train_items = self.trnDicts[-1]
         self.test_set = self.tstDicts
         self.path = self.predir
 
-    def get_adj_mat(self):
-        self.saveAdjMatPath = 'Adj_Mats/' + self.dataset_name
-        os.makedirs(self.saveAdjMatPath, exist_ok=True)
-
-        adj_mat_list = []
-        norm_adj_mat_list = []
-        mean_adj_mat_list = []
-        pre_adj_mat_list = []
+    def load_compiled(self):
+        src_names = self.behs + ['test']
+        txt_files = [self.predir + '/' + name + '.txt' for name in src_names]
+        src_files = txt_files
+        if self.data_source == 'bin':
+            bin_files = [self.predir + '/' + BIN_FILES.get(name, 'trn_' + name) for name in src_names]
+            src_files = [bin_file if os.path.exists(bin_file) else txt_file
+                         for bin_file, txt_file in zip(bin_files, txt_files)]
+
+        work_dir = None
+        if self.stream_chunk > 0:
+            os.makedirs('Compiled_Data/' + self.dataset_name, exist_ok=True)
+            work_dir = tempfile.mkdtemp(prefix='spill', dir='Compiled_Data/' + self.dataset_name)
         try:
+            if not self.use_cache:
+                # the streamed arrays are memory maps into work_dir, they stay valid after it is unlinked
+                return self.compile_data(src_files, txt_files, work_dir, self.check_data)
+
+            cache_dir = os.path.join('Compiled_Data', self.dataset_name)
+            os.makedirs(cache_dir, exist_ok=True)
+            self.saveBinPath = os.path.join(cache_dir, cached_hash_files(src_files, cache_dir))
+            try:
+                t1 = time()
+                compiled = load_compiled_data(self.saveBinPath, src_names)
+                print('already load compiled data', time() - t1)
+            except Exception:
+                save_compiled_data(self.saveBinPath, src_names,
+                                   *self.compile_data(src_files, txt_files, work_dir, check=True))
+                print('compile data to', self.saveBinPath)
+                compiled = load_compiled_data(self.saveBinPath, src_names)
+            return compiled
+        finally:
+            if work_dir is not None:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    def compile_data(self, src_files, txt_files, work_dir=None, check=False):
+        csrs, edges, meta = compile_data(src_files, self.stream_chunk, self.spill_items, work_dir)
+        # with ``check`` binary files are checked against the text files they replace: once before they get
+        # cached, and on the uncached runs only when asked for, as it parses the text files as well
+        if check and src_files != txt_files and all(os.path.exists(txt_file) for txt_file in txt_files):
             t1 = time()
-            for i in range(len(self.behs)):
-                beh = self.behs[i]
-                adj_mat = sp.load_npz(self.saveAdjMatPath + '/s_adj_mat_' + beh + '.npz')
-                norm_adj_mat = sp.load_npz(self.saveAdjMatPath + '/s_norm_adj_mat_' + beh + '.npz')
-                mean_adj_mat = sp.load_npz(self.saveAdjMatPath + '/s_mean_adj_mat_' + beh + '.npz')
-                adj_mat_list.append(adj_mat)
-                norm_adj_mat_list.append(norm_adj_mat)
-                mean_adj_mat_list.append(mean_adj_mat)
-            print('already load adj matrix', time() - t1)
+            ref_dir = None if work_dir is None else tempfile.mkdtemp(dir=work_dir)
+            check_compiled_data(csrs, meta, *compile_data(txt_files, self.stream_chunk, self.spill_items, ref_dir))
+            print('binary data matches the text files', time() - t1)
+        return csrs, edges, meta
 
-        except Exception:
-            for i in range(len(self.behs)):
-                beh = self.behs[i]
-                adj_mat, norm_adj_mat, mean_adj_mat = self.create_adj_mat(self.trnMats[i])
-                adj_mat_list.append(adj_mat)
-                norm_adj_mat_list.append(norm_adj_mat)
-                mean_adj_mat_list.append(mean_adj_mat)
-                sp.save_npz(self.saveAdjMatPath + '/s_adj_mat_' + beh + '.npz', adj_mat)
-                sp.save_npz(self.saveAdjMatPath + '/s_norm_adj_mat_' + beh + '.npz', norm_adj_mat)
-                sp.save_npz(self.saveAdjMatPath + '/s_mean_adj_mat_' + beh + '.npz', mean_adj_mat)
+    def get_adj_mat(self, adj_type='pre'):
+        self.saveAdjMatPath = 'Adj_Mats/' + self.dataset_name
+        os.makedirs(self.saveAdjMatPath, exist_ok=True)
 
-        try:
-            for i in range(len(self.behs)):
-                beh = self.behs[i]
-                pre_adj_mat = sp.load_npz(self.saveAdjMatPath + '/s_pre_adj_mat_' + beh + '.npz')
-                pre_adj_mat_list.append(pre_adj_mat)
-            print('already load pre adj matrix')
-        except Exception:
-            for i in range(len(self.behs)):
-                beh = self.behs[i]
-                adj_mat = adj_mat_list[i]
-                rowsum = np.array(adj_mat.sum(1))
-                d_inv = np.power(rowsum, -0.5).flatten()
-                d_inv[np.isinf(d_inv)] = 0.
-                d_mat_inv = sp.diags(d_inv)
-
-                norm_adj = d_mat_inv.dot(adj_mat)
-                norm_adj = norm_adj.dot(d_mat_inv)
-                print('generate pre adjacency matrix.')
-                pre_adj_mat = norm_adj.tocsr()
-                pre_adj_mat_list.append(pre_adj_mat)
-                sp.save_npz(self.saveAdjMatPath + '/s_pre_adj_mat_' + beh + '.npz', norm_adj)
-
-        return pre_adj_mat_list
-
-    def create_adj_mat(self, which_R):
+        adj_mat_list = [None] * len(self.behs)
+        missing = []
         t1 = time()
-        adj_mat = sp.dok_matrix((self.n_users + self.n_items, self.n_users + self.n_items), dtype=np.float32)  # 全图邻接矩阵
-        adj_mat = adj_mat.tolil()
-        R = which_R.tolil()
-        adj_mat[:self.n_users, self.n_users:] = R
-        adj_mat[self.n_users:, :self.n_users] = R.T
-        adj_mat = adj_mat.todok()
-        print('already create adjacency matrix', adj_mat.shape, time() - t1)
-
-        t2 = time()
-
-        def normalized_adj_single(adj):
-            rowsum = np.array(adj.sum(1))
-
-            d_inv = np.power(rowsum, -1).flatten()
-            d_inv[np.isinf(d_inv)] = 0.
-            d_mat_inv = sp.diags(d_inv)
-
-            norm_adj = d_mat_inv.dot(adj)
-            print('generate single-normalized adjacency matrix.')
-            return norm_adj.tocoo()
-
-        def check_adj_if_equal(adj):
-            dense_A = np.array(adj.todense())
-            degree = np.sum(dense_A, axis=1, keepdims=False)
-
-            temp = np.dot(np.diag(np.power(degree, -1)), dense_A)
-            print('check normalized adjacency matrix whether equal to this laplacian matrix.')
-            return temp
-
-        norm_adj_mat = normalized_adj_single(adj_mat + sp.eye(adj_mat.shape[0]))
-        mean_adj_mat = normalized_adj_single(adj_mat)
-
-        print('already normalize adjacency matrix', time() - t2)
-        return adj_mat.tocsr(), norm_adj_mat.tocsr(), mean_adj_mat.tocsr()
-
-    def get_unified_sim(self, sim_measure):
-        user_unified_sim_file_name = "_".join(["user_unified_sim_mat", sim_measure, ".npz"])
-        item_unified_sim_file_name = "_".join(["item_unified_sim_mat", sim_measure, ".npz"])
-        try:
-            t1 = time()
-            user_unified_sim_mat = sp.load_npz(os.path.join(self.saveSimMatPath, user_unified_sim_file_name))
-            item_unified_sim_mat = sp.load_npz(os.path.join(self.saveSimMatPath, item_unified_sim_file_name))
-            print('already load unified sim'.format(time() - t1))
-        except Exception:
-            print('No Unified Sim File!')
-        return user_unified_sim_mat, item_unified_sim_mat
+        for i in range(len(self.behs)):
+            try:
+                adj_mat_list[i] = sp.load_npz(self.adj_mat_file(self.behs[i], adj_type))
+            except Exception:
+                missing.append(i)
+        if len(missing) < len(self.behs):
+            print('already load %s adj matrix' % adj_type, time() - t1)
+
+        if len(missing) > 0:
+            t2 = time()
+            with ThreadPoolExecutor(max_workers=min(len(missing), os.cpu_count() or 1)) as executor:
+                adj_mats = executor.map(lambda i: self.create_adj_mat(self.trnMats[i], adj_type), missing)
+                for i, adj_mat in zip(missing, adj_mats):
+                    adj_mat_list[i] = adj_mat
+                    sp.save_npz(self.adj_mat_file(self.behs[i], adj_type), adj_mat)
+            print('generate %s adjacency matrix' % adj_type, time() - t2)
+
+        return adj_mat_list
+
+    def adj_mat_file(self, beh, adj_type):
+        prefix = {'plain': 's_adj_mat_', 'norm': 's_norm_adj_mat_', 'mean': 's_mean_adj_mat_',
+                  'pre': 's_pre_adj_mat_'}[adj_type]
+        return self.saveAdjMatPath + '/' + prefix + beh + '.npz'
+
+    def create_adj_mat(self, which_R, adj_type='pre'):
+        """Build one variant of the bipartite adjacency [[0, R], [R^T, 0]] of a behavior.
+
+        plain: A, norm: D^-1 (A + I), mean: D^-1 A, pre: D^-1/2 A D^-1/2.
+        """
+        R = sp.csr_matrix(which_R, dtype=np.float32)
+        adj_mat = sp.bmat([[None, R], [R.T, None]], format='csr')
+        if adj_type == 'plain':
+            return adj_mat
+        if adj_type == 'norm':
+            adj_mat = adj_mat + sp.eye(adj_mat.shape[0], dtype=np.float32, format='csr')
+
+        rowsum = np.asarray(adj_mat.sum(1)).flatten()
+        with np.errstate(divide='ignore'):
+            d_inv = np.power(rowsum, -0.5 if adj_type == 'pre' else -1.)
+        d_inv[np.isinf(d_inv)] = 0.
+
+        # scale the stored values in place instead of multiplying by diagonal matrices
+        rows = np.repeat(np.arange(adj_mat.shape[0]), np.diff(adj_mat.indptr))
+        adj_mat.data *= d_inv[rows]
+        if adj_type == 'pre':
+            adj_mat.data *= d_inv[adj_mat.indices]
+        return adj_mat
+
+    def get_unified_sim(self, sim_measure, sim_behs=(-1,), topk=0, alpha=0.5):
+        sim_mats = []
+        # the built matrices are cached under their build parameters; the shipped, unparameterized matrices hold
+        # every neighbor of the target behavior with alpha 0.5, and are truncated to topk when they match
+        params = "behs%s_top%d_alpha%g" % ('-'.join(str(beh) for beh in sim_behs), topk, alpha)
+        shipped = list(sim_behs) == [-1] and alpha == 0.5
+        for side in ['user', 'item']:
+            sim_file_name = "_".join([side + "_unified_sim_mat", sim_measure, params]) + ".npz"
+            sim_file_name = os.path.join(self.saveSimMatPath, sim_file_name)
+            shipped_file_name = os.path.join(self.saveSimMatPath,
+                                             "_".join([side + "_unified_sim_mat", sim_measure, ".npz"]))
+            try:
+                t1 = time()
+                if not os.path.exists(sim_file_name) and shipped and os.path.exists(shipped_file_name):
+                    sim_mat = top_k_rows(sp.load_npz(shipped_file_name), topk)
+                else:
+                    sim_mat = sp.load_npz(sim_file_name)
+                print('already load %s unified sim' % side, time() - t1)
+            except Exception:
+                print('No %s Unified Sim File! Build it.' % side)
+                t1 = time()
+                R = sum(self.trnMats[i] for i in sim_behs)
+                sim_mat = build_sim_mat(R if side == 'user' else R.T, sim_measure, topk=topk, alpha=alpha)
+                sp.save_npz(sim_file_name, sim_mat)
+                print('build %s unified sim' % side, time() - t1)
+            sim_mats.append(sim_mat)
+        return sim_mats
 
     def negative_pool(self):
         t1 = time()
         for u in self.train_items.keys():
-            neg_items = list(set(range(self.n_items)) - set(self.train_items[u]))
+            neg_items = np.setdiff1d(np.arange(self.n_items), self.train_items[u]).tolist()
             pools = [rd.choice(neg_items) for _ in range(100)]
             self.neg_pools[u] = pools
         print('refresh negative pools', time() - t1)
@@ -281,7 +546,7 @@ class DataHandler(object):
             while True:
                 if len(neg_items) == num: break
                 neg_id = np.random.randint(low=0, high=self.n_items, size=1)[0]
-                if neg_id not in self.train_items[u] and neg_id not in neg_items:
+                if not self.trnStore.contains(u, neg_id) and neg_id not in neg_items:
                     neg_items.append(neg_id)
             return neg_items
 
@@ -298,7 +563,7 @@ class DataHandler(object):
 
     def sample_test(self):
         if self.batch_size <= self.n_users:
-            users = rd.sample(self.test_set.keys(), self.batch_size)
+            users = rd.sample(list(self.test_set.keys()), self.batch_size)
         else:
             users = [rd.choice(self.exist_users) for _ in range(self.batch_size)]
 
@@ -320,7 +585,8 @@ class DataHandler(object):
             while True:
                 if len(neg_items) == num: break
                 neg_id = np.random.randint(low=0, high=self.n_items, size=1)[0]
-                if neg_id not in (self.test_set[u] + self.train_items[u]) and neg_id not in neg_items:
+                if not self.tstStore.contains(u, neg_id) and not self.trnStore.contains(u, neg_id) \
+                        and neg_id not in neg_items:
                     neg_items.append(neg_id)
             return neg_items
 
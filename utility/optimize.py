@@ -23,16 +23,44 @@ class HMG(Optimizer):
             parameter groups
         relax factor: the hyper-parameter to control the magnitude proximity
         beta: the hyper-parameter to control the moving averages of magnitudes, set as 0.9 empirically
+        reduce_grads (callable, optional): sums a list of gradients over the data-parallel workers in place;
+            every task gradient is reduced before its magnitude is measured, so all the workers balance the same
+            global gradients
 
     """
 
-    def __init__(self, params, relax_factor=0.7, beta=0.9):
+    def __init__(self, params, relax_factor=0.7, beta=0.9, reduce_grads=None):
         if not 0.0 <= relax_factor < 1.0:
             raise ValueError("Invalid relax factor: {}".format(relax_factor))
         if not 0.0 <= beta < 1.0:
             raise ValueError("Invalid beta: {}".format(beta))
         defaults = dict(relax_factor=relax_factor, beta=beta)
         super(HMG, self).__init__(params, defaults)
+        self.reduce_grads = reduce_grads
+        self.norms = None
+
+        # every parameter with its size and hyper-parameters; a step keeps the shared parameters (all but
+        # nonshared_idx of each group), selected once per nonshared_idx
+        self.params, self.group_idx, betas, relax_factors = [], [], [], []
+        for group in self.param_groups:
+            for p_idx, p in enumerate(group['params']):
+                self.params.append(p)
+                self.group_idx.append(p_idx)
+                betas.append(group['beta'])
+                relax_factors.append(group['relax_factor'])
+        device, dtype = self.params[0].device, self.params[0].dtype
+        self.sizes = [p.numel() for p in self.params]
+        self.betas = torch.tensor(betas, dtype=dtype, device=device)
+        self.relax_factors = torch.tensor(relax_factors, dtype=dtype, device=device)
+        self.layout = None
+
+    def shared_layout(self, nonshared_idx):
+        """(params, sizes, betas, relax_factors) of the shared parameters."""
+        if self.layout is None or self.layout[0] != nonshared_idx:
+            keep = [i for i, p_idx in enumerate(self.group_idx) if p_idx != nonshared_idx]
+            self.layout = (nonshared_idx, [self.params[i] for i in keep], [self.sizes[i] for i in keep],
+                           self.betas[keep], self.relax_factors[keep])
+        return self.layout[1:]
 
     @torch.no_grad()
     def step(self, loss_array, nonshared_idx):  # , closure=None
@@ -52,61 +80,62 @@ class HMG(Optimizer):
         # return loss
 
     def balance_GradMagnitudes(self, loss_array, nonshared_idx):
-        grad_task = []
+        # the gradients of a task live in one flat buffer, with a view per shared parameter, and the per-parameter
+        # magnitudes, projections and rescalings are computed for all parameters at once, on their device
+        params, sizes, betas, relax_factors = self.shared_layout(nonshared_idx)
+        device, dtype = params[0].device, params[0].dtype
+
+        # moving averages of the gradient magnitudes, [n_tasks, n_params]
+        if self.norms is None:
+            self.norms = torch.zeros(len(loss_array), len(params), dtype=dtype, device=device)
+
+        main_grad, main_views, aux_sum, main_coef = None, None, None, None
         for loss_index, loss in enumerate(loss_array):
+            grad = torch.zeros(sum(sizes), dtype=dtype, device=device)
+            views = torch.split(grad, sizes)
+            for p, view in zip(params, views):
+                # backward accumulates into the flat buffer
+                p.grad = view.view_as(p)
             loss.backward(retain_graph=True)
-            for group in self.param_groups:
-                for p_idx, p in enumerate(group['params']):
-                    if loss_index == 0:
-                        grad_task.append(p.grad.detach().clone())
-
-                    if p_idx == nonshared_idx:
-                        continue
-
-                    if p.grad is None:
-                        print("breaking")
-                        break
-
-                    if p.grad.is_sparse:
-                        raise RuntimeError('HMG does not support sparse gradients')
-
-                    # if p.grad.equal(torch.zeros_like(p.grad)):
-                    #     continue
-
-                    state = self.state[p]
-
-                    # State initialization
-                    if len(state) == 0:
-                        for j, _ in enumerate(loss_array):
-                            if j == 0:
-                                p.norms = [torch.zeros(1).cuda()]
-                            else:
-                                p.norms.append(torch.zeros(1).cuda())
-
-                    # calculate moving averages of gradient magnitudes
-                    beta = group['beta']
-                    p.norms[loss_index] = (p.norms[loss_index] * beta) + ((1 - beta) * torch.norm(p.grad))
-
-                    # narrow the magnitude gap between the main gradient and each auxilary gradient
-                    relax_factor = group['relax_factor']
-
-                    if p.norms[loss_index] > p.norms[0]:
-                        inner_p = torch.sum(p.grad * grad_task[p_idx])
-                        if inner_p < 0:
-                            p.grad = p.grad - inner_p / (torch.norm(grad_task[p_idx]) ** 2) * grad_task[p_idx]
-                        p.grad = (p.norms[0] * p.grad / p.norms[loss_index]) * relax_factor + p.grad * (
-                                1.0 - relax_factor)
-
-                    if loss_index == 0:
-                        state['sum_gradient'] = torch.zeros_like(p.data)
-                        state['sum_gradient'] += p.grad
-                    else:
-                        state['sum_gradient'] += p.grad
-
-                    # have to empty p.grad, otherwise the gradient will be accumulated
-                    if p.grad is not None:
-                        p.grad.detach_()
-                        p.grad.zero_()
-
-                    if loss_index == len(loss_array) - 1:
-                        p.grad = state['sum_gradient']
+            for p, view in zip(params, views):
+                if p.grad.is_sparse:
+                    raise RuntimeError('HMG does not support sparse gradients')
+                if p.grad.data_ptr() != view.data_ptr():
+                    view.copy_(p.grad.reshape(-1))
+            if self.reduce_grads is not None:
+                self.reduce_grads([grad])
+
+            # calculate moving averages of gradient magnitudes
+            norm = torch.stack(torch._foreach_norm(views))
+            self.norms[loss_index] = self.norms[loss_index] * betas + (1 - betas) * norm
+
+            if loss_index == 0:
+                main_grad, main_views, main_sq_norm = grad, views, norm ** 2
+                aux_sum, main_coef = torch.zeros_like(grad), torch.ones_like(norm)
+                continue
+
+            # narrow the magnitude gap between the main gradient and each auxilary gradient: where the auxiliary
+            # magnitude is larger, drop its component against the main gradient and rescale it towards the main
+            # magnitude
+            larger = self.norms[loss_index] > self.norms[0]
+            inner_p = torch.stack([torch.dot(view, main_view) for view, main_view in zip(views, main_views)])
+            projection = torch.where(larger & (inner_p < 0), inner_p / main_sq_norm, torch.zeros_like(inner_p))
+            scale = torch.where(larger, self.norms[0] / self.norms[loss_index] * relax_factors + (1.0 - relax_factors),
+                                torch.ones_like(inner_p))
+            # scale * (grad - projection * main_grad) is applied with per-parameter scalars: scale * grad goes to
+            # aux_sum and -scale * projection to the coefficient of the main gradient, so no temporary buffer
+            # is materialized
+            torch._foreach_mul_(views, list(scale.unbind()))
+            aux_sum.add_(grad)
+            main_coef.sub_(scale * projection)
+
+        # the balanced gradient main_coef * main_grad + aux_sum, in the buffer of the main gradient
+        torch._foreach_mul_(main_views, list(main_coef.unbind()))
+        main_grad.add_(aux_sum)
+        for p, view in zip(params, main_views):
+            p.grad = view.view_as(p)
+
+        if self.reduce_grads is not None:
+            # the non-shared parameter is not balanced and accumulates its local gradients of all the tasks
+            self.reduce_grads([p.grad for group in self.param_groups for p_idx, p in enumerate(group['params'])
+                               if p_idx == nonshared_idx and p.grad is not None])
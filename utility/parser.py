@@ -30,6 +30,17 @@ def parse_args():
 
     parser.add_argument('--dataset', nargs='?', default='Beibei',
                         help='Choose a dataset from {Beibei,Taobao}')
+    parser.add_argument('--data_cache', type=int, default=1,
+                        help='0: Always parse the text files, 1: Load the compiled dataset cache under Compiled_Data/')
+    parser.add_argument('--data_source', type=str, default='txt',
+                        help='txt: Read the *.txt files, bin: Read the binary trn_* / tst_int files where present')
+    parser.add_argument('--check_data', type=int, default=0,
+                        help='1: Check the binary files against the text files on every run with --data_cache 0, '
+                             'they are always checked once when the cache is built')
+    parser.add_argument('--stream_chunk', type=int, default=0,
+                        help='Stream the text files in chunks of this many MB with bounded memory, 0: read them whole')
+    parser.add_argument('--spill_mb', type=int, default=1024,
+                        help='Size in MB of the streamed item buffers before they are spilled to disk')
     parser.add_argument('--verbose', type=int, default=1,
                         help='Interval of evaluation.')
     parser.add_argument('--is_norm', type=int, default=1,
@@ -43,12 +54,15 @@ def parse_args():
                         help='Output sizes of every layer')
     parser.add_argument('--batch_size', type=int, default=256,
                         help='Batch size.')
+    parser.add_argument('--pair_budget', type=int, default=0,
+                        help='Target (user, item) pairs per batch, batching users of similar degree and covering '
+                             'every user each epoch; 0: --batch_size users per batch')
     parser.add_argument('--nhead', type=int, default=1)
     parser.add_argument('--regs', nargs='?', default='[1e-5,1e-5,1e-2]',
                         help='Regularizations.')
 
     parser.add_argument('--adj_type', nargs='?', default='pre',
-                        help='Specify the type of the adjacency (laplacian) matrix from {plain, norm, mean}.')
+                        help='Specify the type of the adjacency (laplacian) matrix from {plain, norm, mean, pre}.')
     parser.add_argument('--gpu_id', type=int, default=0,
                         help='Gpu id')
 
@@ -75,21 +89,58 @@ def parse_args():
     # ******************************   ssl inner loss  paras      ***************************** #
     parser.add_argument('--aug_type', type=int, default=0)
     parser.add_argument('--ssl_ratio', type=float, default=0.5)
+    parser.add_argument('--aug_engine', type=str, default='scipy',
+                        help='scipy: Rebuild the scipy matrices (the original augmentation), torch: Augment the '
+                             'edge list with torch ops')
+    parser.add_argument('--aug_ahead', type=int, default=0,
+                        help='Number of epochs whose augmented graphs are generated in advance, 0: generate on demand '
+                             'from the global RNG, as the original training loop')
+    parser.add_argument('--aug_workers', type=int, default=1, help='Background workers generating augmented graphs')
     parser.add_argument('--ssl_temp', type=float, default=0.5)
     parser.add_argument('--ssl_reg', type=float, default=1)
     parser.add_argument('--ssl_mode', type=str, default='both_side')
+    parser.add_argument('--ssl_neg', type=str, default='full',
+                        help='Negatives of SSLoss, full: All nodes, chunked: All nodes streamed over blocks of '
+                             '--ssl_chunk nodes in bounded memory, in_batch: The batch nodes, '
+                             'sampled: --ssl_n_neg uniformly sampled nodes')
+    parser.add_argument('--ssl_chunk', type=int, default=8192, help='Nodes per block of --ssl_neg chunked')
+    parser.add_argument('--ssl_n_neg', type=int, default=1024, help='Negatives of --ssl_neg sampled')
 
     # ******************************   ssl inter loss  paras      ***************************** #
     parser.add_argument('--ssl_reg_inter', nargs='?', default='[1,1]')
     parser.add_argument('--ssl_inter_mode', type=str, default='both_side')
+    parser.add_argument('--ssl2_fused', type=int, default=0,
+                        help='1: Score every auxiliary behavior of SSLoss2 in one batched matmul (memory grows with '
+                             'the number of auxiliary behaviors), 0: One behavior at a time')
 
     # ******************************  ssl2 similarity paras      ***************************** #
-    parser.add_argument('--sim_measure', type=str, default='swing')
+    parser.add_argument('--sim_measure', type=str, default='swing',
+                        help='Similarity of the unified sim matrices from {swing, cosine, jaccard}.')
+    parser.add_argument('--sim_behs', nargs='?', default='[-1]',
+                        help='Behaviors whose union the missing sim matrices are built from.')
+    parser.add_argument('--sim_topk', type=int, default=0,
+                        help='Neighbors kept per row of the sim matrices, 0: keep all. At least --topk1_user and '
+                             '--topk1_item, which are taken from them.')
+    parser.add_argument('--swing_alpha', type=float, default=0.5)
     parser.add_argument('--topk1_user', type=int, default=10)  #
     parser.add_argument('--topk1_item', type=int, default=10)  #
 
     # ******************************   model hyper paras      ***************************** #
     parser.add_argument('--n_fold', type=int, default=50)
+    parser.add_argument('--sample_train', type=int, default=0,
+                        help='1: Train on the sampled receptive field of every batch, with the losses restricted to the '
+                             'batch users and items; 0: Propagate the full graph')
+    parser.add_argument('--fanout', nargs='?', default='[20]',
+                        help='Neighbors sampled per node, relation and layer (one value for all layers), 0: all')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='Number of training batches built ahead in a background thread, 0: build them inline')
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help='Data-parallel training processes started on this host, each on a share of every batch')
+    parser.add_argument('--n_nodes', type=int, default=1, help='Hosts of the data-parallel training')
+    parser.add_argument('--node_rank', type=int, default=0, help='Rank of this host among the --n_nodes hosts')
+    parser.add_argument('--master_addr', type=str, default='127.0.0.1', help='Address of the host of rank 0')
+    parser.add_argument('--master_port', type=int, default=29500, help='Free port on the host of rank 0')
+    parser.add_argument('--dist_backend', type=str, default='gloo', help='torch.distributed backend')
     parser.add_argument('--att_dim', type=int, default=16, help='self att dim')  # d_a
     parser.add_argument('--wid', nargs='?', default='[0.1,0.1,0.1]',
                         help='negative weight, [0.1,0.1,0.1] for beibei, [0.01,0.01,0.01] for taobao')
@@ -99,11 +150,18 @@ def parse_args():
 
     parser.add_argument('--mf_decay', type=float, default=1, help='mf loss decay')  # mf loss decay
 
+    parser.add_argument('--rec_loss', type=str, default='padded',
+                        help='padded: Labels padded (and truncated) to the 99.99th-percentile item count, '
+                             'csr: Every positive of the batch users, without padding')
     parser.add_argument('--coefficient', nargs='?', default='[0.0/6, 5.0/6, 1.0/6]',
                         help='Regularization, [0.0/6, 5.0/6, 1.0/6] for beibei, [1.0/6, 4.0/6, 1.0/6] for taobao')
 
     parser.add_argument('--mess_dropout', nargs='?', default='[0.3]',
                         help='Keep probability w.r.t. message dropout')
+    parser.add_argument('--precision', type=str, default='fp32',
+                        help='fp32, or bf16: Autocast the dense stages of training to bfloat16')
+    parser.add_argument('--checkpoint', nargs='?', default='[0,0,0]',
+                        help='Per view (main, sub1, sub2), 1: Recompute the propagation layers in backward to save memory')
 
     parser.add_argument('--dropout_ratio', type=float, default=0.5)
 
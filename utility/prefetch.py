@@ -0,0 +1,94 @@
+'''
+Background producer that builds the next training batches while the current step runs.
+'''
+import queue
+import threading
+
+import torch
+
+
+def to_device(array, device):
+    """numpy array -> tensor on ``device``; on cuda the copy goes from pinned memory and does not block the host."""
+    tensor = torch.from_numpy(array)
+    if device.type == 'cuda':
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
+
+
+def _tensors(obj):
+    if torch.is_tensor(obj):
+        return [obj]
+    if isinstance(obj, (list, tuple)):
+        return [t for item in obj for t in _tensors(item)]
+    return []
+
+
+class Prefetcher(object):
+    """Yields ``make_batch(0), ..., make_batch(n_batch - 1)`` in order while a background thread builds them,
+    at most ``depth`` batches ahead of the consumer.
+
+    Batches are built strictly in order by a single thread, so the result does not depend on timing. On cuda the
+    host-to-device copies of a batch are issued on a side stream and the consumer's stream waits on them only
+    when it takes the batch. With ``depth`` 0 batches are built inline.
+    """
+
+    def __init__(self, make_batch, n_batch, device, depth=2):
+        self.make_batch = make_batch
+        self.n_batch = n_batch
+        self.device = device
+        self.depth = depth
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' and depth > 0 else None
+
+    def __len__(self):
+        return self.n_batch
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for idx in range(self.n_batch):
+                yield self.make_batch(idx)
+            return
+
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        worker.start()
+        try:
+            for _ in range(self.n_batch):
+                batch, event = batches.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    for tensor in _tensors(batch):
+                        tensor.record_stream(current)
+                yield batch
+        finally:
+            stop.set()
+            while worker.is_alive():
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    worker.join(0.01)
+
+    def _produce(self, batches, stop):
+        for idx in range(self.n_batch):
+            try:
+                event = None
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        batch = self.make_batch(idx)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    batch = self.make_batch(idx)
+            except Exception as e:
+                batch, event = e, None
+            while not stop.is_set():
+                try:
+                    batches.put((batch, event), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set() or isinstance(batch, Exception):
+                return
@@ -0,0 +1,117 @@
+'''
+Layer-wise neighbor sampling of the propagation graphs, for training on the receptive field of a mini-batch
+instead of the full graph.
+'''
+import torch
+
+
+def sparse_to_csr(adj):
+    """(crow, col, val) arrays of a sparse COO or CSR tensor."""
+    if adj.layout == torch.sparse_csr:
+        return adj.crow_indices().long(), adj.col_indices().long(), adj.values()
+    adj = adj.coalesce()
+    rows, cols = adj.indices()
+    crow = torch.zeros(adj.shape[0] + 1, dtype=torch.long, device=rows.device)
+    crow[1:] = torch.cumsum(torch.bincount(rows, minlength=adj.shape[0]), 0)
+    return crow, cols, adj.values()
+
+
+def sample_rows(csr, rows, fanout, generator=None):
+    """Sampled edges of ``rows``: every edge of a row with at most ``fanout`` neighbors (or any row if
+    ``fanout`` is 0), else ``fanout`` edges drawn with replacement and scaled by degree / fanout, so the
+    sampled aggregation is an unbiased estimate of the full one.
+
+    Returns the position of the row in ``rows``, the column and the value of every sampled edge.
+    """
+    crow, col, val = csr
+    start = crow[rows]
+    deg = crow[rows + 1] - start
+    full = deg <= fanout if fanout > 0 else torch.ones_like(deg, dtype=torch.bool)
+
+    n_full = deg * full
+    r_full = torch.repeat_interleave(torch.arange(len(rows), device=rows.device), n_full)
+    offset = torch.arange(len(r_full), device=rows.device) - torch.repeat_interleave(torch.cumsum(n_full, 0) - n_full,
+                                                                                     n_full)
+    pos_full = start[r_full] + offset
+
+    r_part = torch.repeat_interleave(torch.nonzero(~full).squeeze(1), fanout) if fanout > 0 else r_full[:0]
+    draw = torch.rand(len(r_part), generator=generator, device=rows.device)
+    pos_part = start[r_part] + (draw * deg[r_part]).long()
+
+    r = torch.cat([r_full, r_part])
+    pos = torch.cat([pos_full, pos_part])
+    scale = torch.cat([torch.ones(len(r_full), device=val.device),
+                       deg[r_part].to(val.device, val.dtype) / fanout])
+    return r, col[pos], val[pos] * scale
+
+
+class SampledGraph(object):
+    """Receptive field of the seed nodes in every view.
+
+    For view v, ``nodes[v][k]`` are the sorted node ids whose layer-k embeddings are computed (the seeds are
+    ``nodes[v][-1]``), ``adjs[v][k]`` the per-relation sparse [len(nodes[v][k + 1]), len(nodes[v][k])] sampled
+    adjacencies of layer k, and ``out_pos[v][k]`` the positions of the seeds in ``nodes[v][k]``.
+    """
+
+    def __init__(self, seeds, nodes, adjs, out_pos):
+        self.seeds = seeds
+        self.nodes = nodes
+        self.adjs = adjs
+        self.out_pos = out_pos
+
+
+class NeighborSampler(object):
+    """Samples the L-hop receptive field of seed nodes from the per-view, per-layer, per-relation propagation
+    graphs (``view_adjs[v][k][i]``, full-graph sparse tensors).
+
+    Layer k of every relation is sampled from the union of the layer-(k + 1) nodes, since the cross-relation
+    attention mixes the relations of a node.
+    """
+
+    def __init__(self, view_adjs, fanouts, generator=None, csrs=None):
+        # the views and layers share most of their adjacencies, so every distinct one is converted once, by id;
+        # ``csrs`` maps the id of an adjacency to its converted arrays, e.g. those of the static graphs kept
+        # across epochs, which are not converted again
+        csrs = dict(csrs or {})
+        for adjs in view_adjs:
+            for layer_adjs in adjs:
+                for adj in layer_adjs:
+                    if id(adj) not in csrs:
+                        csrs[id(adj)] = sparse_to_csr(adj)
+        self.view_csrs = [[[csrs[id(adj)] for adj in layer_adjs] for layer_adjs in adjs] for adjs in view_adjs]
+        self.fanouts = fanouts
+        self.generator = generator
+
+    def sample(self, seeds):
+        seeds = torch.unique(seeds)
+        nodes, adjs, out_pos = [], [], []
+        for csrs in self.view_csrs:
+            n_layers = len(csrs)
+            view_nodes = [seeds]
+            view_adjs = []
+            for k in reversed(range(n_layers)):
+                out_nodes = view_nodes[0]
+                edges = [sample_rows(csr, out_nodes, self.fanouts[k], self.generator) for csr in csrs[k]]
+                in_nodes = torch.unique(torch.cat([out_nodes] + [cols for _, cols, _ in edges]))
+                view_adjs.insert(0, [torch.sparse_coo_tensor(torch.stack([r, torch.searchsorted(in_nodes, cols)]),
+                                                             vals, (len(out_nodes), len(in_nodes))).coalesce()
+                                     for r, cols, vals in edges])
+                view_nodes.insert(0, in_nodes)
+            nodes.append(view_nodes)
+            adjs.append(view_adjs)
+            out_pos.append([torch.searchsorted(layer_nodes, seeds) for layer_nodes in view_nodes])
+        return SampledGraph(seeds, nodes, adjs, out_pos)
+
+
+def local_ids(nodes, ids):
+    """Positions of ``ids`` in the sorted ``nodes``; ids beyond the last node map to len(nodes)."""
+    return torch.searchsorted(nodes, ids)
+
+
+def local_mask_indices(nodes, batch_indices):
+    """Restrict (rows, cols) mask indices to the columns in ``nodes`` and renumber the columns."""
+    rows, cols = batch_indices
+    pos = torch.searchsorted(nodes, cols)
+    valid = pos < len(nodes)
+    valid[valid.clone()] = nodes[pos[valid]] == cols[valid]
+    return rows[valid], pos[valid]
@@ -0,0 +1,168 @@
+'''
+Similarity engine for the unified user-user / item-item similarity matrices under Sim_Mats/.
+
+The matrices are computed row block by row block in a process pool and only the top-k neighbors of every row
+are kept, so the output is a sparse CSR whatever the number of users or items.
+'''
+import multiprocessing
+
+import numpy as np
+import scipy.sparse as sp
+
+SIM_MEASURES = ['swing', 'cosine', 'jaccard']
+
+# read-only operands of the worker processes, inherited on fork instead of being pickled per task
+_shared = {}
+
+
+def _init_worker(X, XT, sim_measure, alpha, topk, block_budget):
+    _shared.update(X=X, XT=XT, sim_measure=sim_measure, alpha=alpha, topk=topk, block_budget=block_budget)
+
+
+def _top_k(cols, vals, topk):
+    keep = vals != 0
+    cols, vals = cols[keep], vals[keep]
+    if 0 < topk < len(vals):
+        part = np.argpartition(-vals, topk - 1)[:topk]
+        cols, vals = cols[part], vals[part]
+    order = np.argsort(cols)
+    return cols[order], vals[order]
+
+
+def _swing_row(i, X, XT, alpha, block_budget):
+    """sim(i, j) = sum over unordered pairs {u, v} of N(i) & N(j) of 1 / (alpha + |N(u) & N(v)|)."""
+    ctx = X.indices[X.indptr[i]:X.indptr[i + 1]]
+    if len(ctx) < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    sub = XT[ctx]
+    cols = np.unique(sub.indices)
+    sub = sub[:, cols].tocsr()
+    sub_csc = sub.tocsc()
+
+    # sum_{u != v} W[u, v] sub[u, j] sub[v, j] for every column j, with W = 1 / (alpha + sub @ sub.T): tiled over
+    # blocks of u and chunks of j, so no dense array exceeds block_budget floats whatever |N(i)|
+    vals = np.zeros(len(cols))
+    n_rows = max(1, block_budget // len(ctx))
+    step = max(1, block_budget // n_rows)
+    for row in range(0, len(ctx), n_rows):
+        sub_rows = sub[row:row + n_rows]
+        W = 1. / (alpha + (sub_rows @ sub.T).toarray())  # [rows, |N(i)|]
+        W[np.arange(W.shape[0]), row + np.arange(W.shape[0])] = 0.
+        sub_rows = sub_rows.tocsc()
+        for start in range(0, len(cols), step):
+            WS = (sub_csc[:, start:start + step].T @ W.T).T  # [rows, step]
+            vals[start:start + step] += np.asarray(sub_rows[:, start:start + step].multiply(WS).sum(0)).ravel()
+    vals *= 0.5
+    vals[cols == i] = 0.
+    return cols, vals
+
+
+def _sim_block(rows):
+    X, XT = _shared['X'], _shared['XT']
+    sim_measure, topk = _shared['sim_measure'], _shared['topk']
+    indptr, indices, data = [0], [], []
+
+    if sim_measure == 'swing':
+        for i in rows:
+            cols, vals = _top_k(*_swing_row(i, X, XT, _shared['alpha'], _shared['block_budget']), topk)
+            indices.append(cols)
+            data.append(vals)
+            indptr.append(indptr[-1] + len(cols))
+    else:
+        block = X[rows[0]:rows[-1] + 1]
+        inter = (block @ X.T).tocsr()
+        deg = np.diff(X.indptr)
+        for r, i in enumerate(rows):
+            cols = inter.indices[inter.indptr[r]:inter.indptr[r + 1]]
+            vals = inter.data[inter.indptr[r]:inter.indptr[r + 1]].astype(np.float64)
+            if sim_measure == 'cosine':
+                vals = vals / np.sqrt(deg[i] * deg[cols])
+            else:
+                vals = vals / (deg[i] + deg[cols] - vals)
+            vals[cols == i] = 0.
+            cols, vals = _top_k(cols, vals, topk)
+            indices.append(cols)
+            data.append(vals)
+            indptr.append(indptr[-1] + len(cols))
+
+    return np.array(indptr), np.concatenate(indices), np.concatenate(data)
+
+
+def build_sim_mat(X, sim_measure='swing', topk=0, alpha=0.5, n_jobs=None, block_size=256, block_budget=1 << 22):
+    """Row-wise similarity between the rows of the binary CSR ``X`` (e.g. users x items for user similarity).
+
+    Arguments:
+        topk: number of neighbors kept per row, 0 keeps every nonzero
+        alpha: smoothing term of swing
+        n_jobs: worker processes, defaults to the number of cores
+        block_size: rows per task
+        block_budget: maximum number of dense floats a swing worker materializes at once
+    """
+    if sim_measure not in SIM_MEASURES:
+        raise ValueError('Invalid sim measure: {}, choose from {}'.format(sim_measure, SIM_MEASURES))
+    X = sp.csr_matrix(X, dtype=np.float64)
+    X.sum_duplicates()
+    X.data[:] = 1.
+    XT = X.T.tocsr()
+    n = X.shape[0]
+    blocks = [np.arange(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    initargs = (X, XT, sim_measure, alpha, topk, block_budget)
+
+    if n_jobs <= 1:
+        _init_worker(*initargs)
+        results = [_sim_block(rows) for rows in blocks]
+    else:
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=initargs) as pool:
+            results = pool.map(_sim_block, blocks)
+
+    indptr = [np.zeros(1, dtype=np.int64)]
+    for block_indptr, _, _ in results:
+        indptr.append(block_indptr[1:] + indptr[-1][-1])
+    indptr = np.concatenate(indptr)
+    indices = np.concatenate([block_indices for _, block_indices, _ in results])
+    data = np.concatenate([block_data for _, _, block_data in results])
+    return sp.csr_matrix((data, indices, indptr), shape=(n, n))
+
+
+def top_k_rows(sim_mat, topk):
+    """CSR ``sim_mat`` keeping the ``topk`` largest nonzeros of every row (all of them if topk is 0)."""
+    sim_mat = sp.csr_matrix(sim_mat)
+    if topk <= 0:
+        return sim_mat
+    rows = [_top_k(sim_mat.indices[start:end], sim_mat.data[start:end], topk)
+            for start, end in zip(sim_mat.indptr[:-1], sim_mat.indptr[1:])]
+    indptr = np.concatenate([[0], np.cumsum([len(cols) for cols, _ in rows])])
+    indices = np.concatenate([cols for cols, _ in rows])
+    data = np.concatenate([vals for _, vals in rows])
+    return sp.csr_matrix((data, indices, indptr), shape=sim_mat.shape)
+
+
+def top_k_mask(sim_mat, topk):
+    """Boolean CSR marking the entries of every row strictly greater than the row's k-th largest value.
+
+    The k-th largest value is taken over the dense row (implicit zeros included), exactly like a torch.topk
+    over the densified matrix, but memory stays O(nnz). Similarities are assumed nonnegative: a row whose k-th
+    value is negative would also mask its implicit zeros, which are not represented here.
+    """
+    sim_mat = sp.csr_matrix(sim_mat)
+    sim_mat.sum_duplicates()
+    sim_mat.eliminate_zeros()
+    n_rows, n_cols = sim_mat.shape
+    k = min(topk, n_cols)
+    starts = sim_mat.indptr[:-1]
+    n_zeros = n_cols - np.diff(sim_mat.indptr)
+    rows = np.repeat(np.arange(n_rows), np.diff(sim_mat.indptr))
+
+    # values of every row in descending order, then the k-th largest with the implicit zeros slotted in
+    vals = sim_mat.data[np.lexsort((-sim_mat.data, rows))]
+    n_pos = np.bincount(rows[sim_mat.data > 0], minlength=n_rows)
+    kth = np.zeros(n_rows, dtype=vals.dtype)
+    pos_kth = k <= n_pos
+    neg_kth = k > n_pos + n_zeros
+    kth[pos_kth] = vals[starts[pos_kth] + k - 1]
+    kth[neg_kth] = vals[starts[neg_kth] + k - 1 - n_zeros[neg_kth]]
+
+    keep = sim_mat.data > kth[rows]
+    return sp.csr_matrix((np.ones(keep.sum(), dtype=bool), (rows[keep], sim_mat.indices[keep])),
+                         shape=sim_mat.shape)